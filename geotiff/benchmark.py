@@ -0,0 +1,360 @@
+import sys
+import time
+from decimal import Decimal
+
+import numpy as np
+
+from osgeo import gdal
+
+import arger
+import georef
+import geotiff
+import tilegrid
+
+def main(argv):
+    benchOpts = Options()
+    commands = [
+    dict(
+        command =  "tif",
+        alias =  ["t"],
+        input =  True,
+    ),
+    dict(
+        command =  "model",
+        input =  True,
+    ),
+    dict(
+        command =  "slices",
+        input =  True,
+        example = "64"
+    ),
+    dict(
+        command =  "batch-sizes",
+        key = "batchSizes",
+        input =  True,
+        example = "1,4,8,16"
+    ),
+    dict(
+        command =  "autotune",
+    ),
+    dict(
+        command =  "batch-size",
+        key = "batchSize",
+        input =  True,
+        example = "8"
+    ),
+    dict(
+        command =  "nms",
+    ),
+    dict(
+        command =  "nms-sizes",
+        key = "nmsSizes",
+        input =  True,
+        example = "100,1000,10000"
+    ),
+    dict(
+        command =  "georef",
+    ),
+    dict(
+        command =  "georef-boxes",
+        key = "georefBoxes",
+        input =  True,
+        example = "10000"
+    ),
+    dict(
+        command =  "reference-max",
+        key = "referenceMax",
+        input =  True,
+        example = "1000"
+    ),
+    ]
+
+    try:
+        opts = arger.parseArgs(argv, commands)
+    except Exception as err:
+        arger.printHelp("benchmark.py", commands)
+        sys.exit(2)
+
+    if opts.get("slices"):
+        opts["slices"] = int(opts["slices"])
+
+    if opts.get("batchSizes"):
+        opts["batchSizes"] = amap(int, opts["batchSizes"].split(","))
+
+    if opts.get("batchSize"):
+        opts["batchSize"] = int(opts["batchSize"])
+
+    if opts.get("nmsSizes"):
+        opts["nmsSizes"] = amap(int, opts["nmsSizes"].split(","))
+
+    if opts.get("referenceMax"):
+        opts["referenceMax"] = int(opts["referenceMax"])
+
+    if opts.get("georefBoxes"):
+        opts["georefBoxes"] = int(opts["georefBoxes"])
+
+    benchOpts.__dict__.update(opts)
+
+    if benchOpts.nms:
+        benchmarkNms(benchOpts)
+        return
+
+    if benchOpts.georef:
+        checkGeoref(benchOpts)
+        return
+
+    if benchOpts.tif == None or benchOpts.model == None:
+        arger.printHelp("benchmark.py", commands)
+        sys.exit(2)
+
+    if benchOpts.autotune:
+        autotuneReplicas(benchOpts)
+    else:
+        benchmarkBatches(benchOpts)
+
+def amap(f, l):
+    return list(map(f, l))
+
+class Options:
+    tif = None
+    model = None
+    slices = 64
+    sliceSize = 500
+    overlap = 50
+    batchSizes = [1, 4, 8, 16]
+    autotune = False
+    batchSize = 8
+    nms = False
+    nmsSizes = [100, 1000, 10000]
+    referenceMax = 1000
+    georef = False
+    georefBoxes = 10000
+    classes = 3
+
+def loadSlices(opts):
+    gdal.UseExceptions();
+    ds = gdal.Open(opts.tif)
+
+    grid = tilegrid.FromDataset(ds, opts.sliceSize, opts.overlap)
+    grid = grid.subset(grid.cells[:opts.slices])
+
+    return [
+        geotiff.TileToImage(tile).copy()
+        for tile in geotiff.IterTiles(ds, grid)
+    ]
+
+def benchmarkBatches(opts):
+    from model import loadWeights, batchDetection
+
+    modelConfig, weights = loadWeights(opts.model)
+    images = loadSlices(opts)
+
+    # Warm up, the first call builds the prediction function.
+    batchDetection(modelConfig, weights, images[:1])
+
+    print("Detection throughput over {0} slices".format(len(images)))
+    for batchSize in opts.batchSizes:
+        start = time.time()
+        for i in range(0, len(images), batchSize):
+            batchDetection(modelConfig, weights, images[i:i + batchSize])
+
+        elapsed = time.time() - start
+        print("  batch size {0}: {1:.2f} slices/s".format(
+            batchSize, len(images) / elapsed
+        ))
+
+def autotuneReplicas(opts):
+    import replicas
+
+    images = loadSlices(opts)
+
+    print("Replica throughput over {0} slices, batch size {1}".format(len(images), opts.batchSize))
+    measured = replicas.Autotune(opts.model, images, opts.batchSize)
+
+    best = measured[0]
+    print("Best: --replicas {0} --replica-threads {1}, {2:.2f} tiles/s".format(
+        best["replicas"], best["threads"], best["tilesPerSecond"]
+    ))
+
+def randomDetections(count, classes, seed = 0):
+    """
+    Clustered, overlapping integer boxes and sparse class scores, like the
+    candidates of a dense scene before NMS.
+    """
+    rng = np.random.default_rng(seed)
+
+    centers = rng.uniform(0, 500, (max(1, count // 8), 2))
+    xy = centers[rng.integers(0, len(centers), count)] + rng.normal(0, 6, (count, 2))
+    wh = rng.uniform(10, 40, (count, 2))
+
+    boxes = np.floor(np.concatenate([xy - wh / 2, xy + wh / 2], axis = 1))
+
+    scores = rng.uniform(0.5, 1.0, (count, classes)).astype(np.float32)
+    scores *= rng.uniform(0, 1, (count, classes)) < 0.5
+
+    return boxes, scores
+
+def benchmarkNms(opts):
+    from utils.utils import nms_array, do_nms_pairwise
+    from utils.bbox import BoundBox
+
+    print("NMS over {0} classes, nms_array against the pairwise loop".format(opts.classes))
+    for count in opts.nmsSizes:
+        boxes, scores = randomDetections(count, opts.classes)
+
+        start = time.time()
+        suppressed = nms_array(boxes, scores, 0.45)
+        arrayTime = time.time() - start
+
+        start = time.time()
+        nms_array(boxes, scores, 0.45, method = "gaussian", score_thresh = 0.5)
+        softTime = time.time() - start
+
+        start = time.time()
+        nms_array(boxes, scores, 0.45, top_k = 100)
+        topKTime = time.time() - start
+
+        line = "  {0} boxes: array {1:.4f}s, soft {2:.4f}s, top 100 {3:.4f}s".format(
+            count, arrayTime, softTime, topKTime
+        )
+
+        if count <= opts.referenceMax:
+            reference = [
+                BoundBox(*[int(v) for v in box], classes = classes.copy())
+                for box, classes in zip(boxes, scores)
+            ]
+
+            start = time.time()
+            do_nms_pairwise(reference, 0.45)
+            pairwiseTime = time.time() - start
+
+            same = np.array_equal(np.array([box.classes for box in reference]), suppressed)
+            line = line + ", pairwise {0:.4f}s, {1}".format(
+                pairwiseTime, "identical" if same else "DIFFERENT"
+            )
+
+        print(line)
+
+def checkGeoref(opts):
+    """
+    Compares georef against the Decimal georeferencing it replaced, on
+    random boxes over an 80k x 80k raster with a UTM-like geotransform.
+
+    Map coordinates have to agree within a millionth of a pixel. Pixel
+    boxes of round-tripped rings have to come back exactly from georef,
+    while the Decimal path truncates values a hair below a whole pixel and
+    may be one pixel short, never more and never over.
+    """
+    rng = np.random.default_rng(0)
+    gt = (512345.678, 0.0312, 0.0, 6234567.891, 0.0, -0.0312)
+    cols, rows = 80000, 80000
+
+    xy = rng.integers(1, 79000, (opts.georefBoxes, 2))
+    wh = rng.integers(1, 1000, (opts.georefBoxes, 2))
+    boxes = np.concatenate([xy, wh], axis = 1)
+
+    start = time.time()
+    coords = georef.PixelBoxesToCoords(gt, boxes)
+    arrayTime = time.time() - start
+
+    start = time.time()
+    reference = np.array([
+        [float(c) for c in decimalCoordinatesFromPixelBox(gt, cols, rows, *box)]
+        for box in boxes.tolist()
+    ])
+    decimalTime = time.time() - start
+
+    error = float(np.abs(coords - reference).max())
+    tolerance = 1e-6 * abs(gt[1])
+
+    print("Pixel boxes to map over {0} boxes: array {1:.4f}s, Decimal {2:.4f}s, max difference {3:.3g} map units".format(
+        len(boxes), arrayTime, decimalTime, error
+    ))
+
+    if error > tolerance:
+        raise Exception("PixelBoxesToCoords is off by {0} map units, more than {1}.".format(error, tolerance))
+
+    shapes = [
+        [[left, top], [right, top], [right, bottom], [left, bottom]]
+        for left, top, right, bottom in coords.tolist()
+    ]
+    expected = np.concatenate([xy, xy + wh], axis = 1)
+
+    start = time.time()
+    pixels = georef.ShapesToPixelBoxes(gt, shapes)
+    arrayTime = time.time() - start
+
+    start = time.time()
+    old = np.array(decimalPixelBoxesFromShapes(gt, cols, rows, shapes))
+    decimalTime = time.time() - start
+
+    shift = pixels - old
+    print("Map to pixel boxes over {0} boxes: array {1:.4f}s, Decimal {2:.4f}s, {3} exact, {4} with the Decimal path one pixel short".format(
+        len(shapes), arrayTime, decimalTime,
+        int(np.all(pixels == expected, axis = 1).sum()),
+        int(np.any(shift != 0, axis = 1).sum())
+    ))
+
+    if not np.array_equal(pixels, expected):
+        raise Exception("ShapesToPixelBoxes does not round trip the pixel boxes.")
+
+    if not np.all((shift == 0) | (shift == 1)):
+        raise Exception("ShapesToPixelBoxes differs from the Decimal path by more than its one pixel snap.")
+
+def decimalExtent(gt, cols, rows):
+    # The Decimal GetExtent, kept as the reference.
+    ext = []
+
+    gt = amap(Decimal, gt)
+
+    xarr = amap(Decimal, [0, cols])
+    yarr = amap(Decimal, [0, rows])
+
+    for px in xarr:
+        for py in yarr:
+            ext.append([gt[0] + (px * gt[1]) + (py * gt[2]), gt[3] + (px * gt[4]) + (py * gt[5])])
+
+        yarr.reverse()
+
+    return ext
+
+def decimalCoordinatesFromPixelBox(gt, cols, rows, x, y, width, height):
+    # The Decimal GetCoordinatesFromPixelBox, kept as the reference.
+    bottomLeft, topLeft, topRight, bottomRight = decimalExtent(gt, cols, rows)
+
+    cols, rows, x, y = amap(Decimal, [cols, rows, x, y])
+
+    xOrigin = Decimal(gt[0])
+    yOrigin = Decimal(gt[3])
+
+    xlen = topRight[0] - topLeft[0]
+    ylen = bottomRight[1] - topRight[1]
+
+    return [
+        xOrigin + (x / cols) * xlen,
+        yOrigin - (y / rows) * ylen,
+        xOrigin + ((x + width) / cols) * xlen,
+        yOrigin - ((y + height) / rows) * ylen,
+    ]
+
+def decimalPixelBoxesFromShapes(gt, cols, rows, shapes):
+    # The Decimal getPixelBoxesFromShapes, kept as the reference.
+    bottomLeft, topLeft, topRight, bottomRight = decimalExtent(gt, cols, rows)
+
+    xOrigin = Decimal(gt[0])
+    yOrigin = Decimal(gt[3])
+
+    xlen = topRight[0] - topLeft[0]
+    ylen = bottomRight[1] - topRight[1]
+
+    parsed = []
+    for shape in shapes:
+        xs = [(Decimal(lon) - xOrigin) / xlen * cols for lon, lat in shape]
+        ys = [(yOrigin - Decimal(lat)) / ylen * rows for lon, lat in shape]
+
+        parsed.append([int(min(xs)), int(min(ys)), int(max(xs)), int(max(ys))])
+
+    return parsed
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,166 @@
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+
+import arger
+import tilegrid
+import contentfilter
+
+def main(argv):
+    calOpts = Options()
+    commands = [
+    dict(
+        command =  "voc",
+        input =  True,
+        required =  True,
+    ),
+    dict(
+        command =  "filter",
+        key = "method",
+        input =  True,
+        example = "variance"
+    ),
+    dict(
+        command =  "slice",
+        key = "sliceSize",
+        input =  True
+    ),
+    dict(
+        command =  "overlap",
+        input =  True
+    ),
+    dict(
+        command =  "background",
+        input =  True
+    ),
+    dict(
+        command =  "save-background",
+        key = "saveBackground",
+        input =  True
+    ),
+    ]
+
+    try:
+        opts = arger.parseArgs(argv, commands)
+    except Exception as err:
+        arger.printHelp("calibrate-filter.py", commands)
+        sys.exit(2)
+
+    for key in ["sliceSize", "overlap"]:
+        if opts.get(key):
+            opts[key] = int(opts[key])
+
+    calOpts.__dict__.update(opts)
+    calibrate(calOpts)
+
+class Options:
+    voc = None
+    method = "variance"
+    sliceSize = 500
+    overlap = 50
+    background = None
+    saveBackground = None
+
+def calibrate(opts):
+    """
+    Slices every labelled image of a PASCAL VOC directory the way the
+    predict scripts slice a raster, scores the tiles with the content filter
+    and reports, for a range of thresholds, the share of tiles skipped and
+    the share of labelled objects still seen whole by a kept tile.
+    """
+    background = None
+    if opts.background != None:
+        background = contentfilter.LoadBackground(opts.background)
+    elif opts.method == "histogram" or opts.saveBackground != None:
+        # Learn the background from the tiles without any objects.
+        background = contentfilter.BackgroundModel()
+        for image, seen in labelledTiles(opts):
+            if len(seen) == 0:
+                background.add(image[::4, ::4])
+
+        print("Learned background model from {0} empty tiles".format(background.count))
+
+        if opts.saveBackground != None and background.count > 0:
+            background.save(opts.saveBackground)
+
+    scorer = contentfilter.ContentFilter(opts.method, background = background)
+
+    # Only the scores and object ids are kept, not the images.
+    tiles = [(scorer.score(image), seen) for image, seen in labelledTiles(opts)]
+    if len(tiles) == 0:
+        print("No labelled images in {0}".format(opts.voc))
+        return
+
+    scores = np.array([score for score, seen in tiles])
+
+    objects = set()
+    for score, seen in tiles:
+        objects.update(seen)
+
+    print("{0} tiles, {1} objects seen whole by a tile, {2} filter".format(
+        len(tiles), len(objects), opts.method
+    ))
+    print("  threshold   skipped   recall")
+
+    for quantile in [0, 10, 20, 30, 40, 50, 60, 70, 80, 90]:
+        threshold = float(np.percentile(scores, quantile))
+
+        recalled = set()
+        kept = 0
+        for score, seen in tiles:
+            if score >= threshold:
+                kept = kept + 1
+                recalled.update(seen)
+
+        print("  {0:9.4f}   {1:6.1f}%   {2:5.1f}%".format(
+            threshold,
+            100.0 * (len(tiles) - kept) / len(tiles),
+            100.0 * len(recalled) / max(1, len(objects))
+        ))
+
+def labelledTiles(opts):
+    """
+    Yields every tile as its image and the ids of the objects lying wholly
+    inside it.
+    """
+    for name in sorted(os.listdir(opts.voc)):
+        if not name.endswith(".xml"):
+            continue
+
+        imageName, shapes = parseVOC(os.path.join(opts.voc, name))
+
+        image = cv2.imread(os.path.join(opts.voc, imageName))
+        if image is None:
+            print("Missing image {0}".format(imageName))
+            continue
+
+        grid = tilegrid.TileGrid(image.shape[1], image.shape[0], opts.sliceSize, opts.overlap)
+        for row, col in grid.cells:
+            xs, ys, w, h = grid.window(row, col)
+
+            inside = [
+                (name, index) for index, shape in enumerate(shapes)
+                if xs <= shape["xmin"] and shape["xmax"] <= xs + w
+                and ys <= shape["ymin"] and shape["ymax"] <= ys + h
+            ]
+
+            yield image[ys:ys + h, xs:xs + w], inside
+
+def parseVOC(path):
+    root = ET.parse(path).getroot()
+
+    shapes = []
+    for obj in root.findall("object"):
+        box = obj.find("bndbox")
+        shapes.append(dict(
+            (key, int(float(box.find(key).text)))
+            for key in ["xmin", "ymin", "xmax", "ymax"]
+        ))
+
+    return root.find("filename").text, shapes
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,265 @@
+import sys
+
+import numpy as np
+
+from osgeo import gdal
+
+import arger
+import geotiff
+import tilegrid
+import tileencoding
+from dedupe import iou
+
+def main(argv):
+    compareOpts = Options()
+    commands = [
+    dict(
+        command =  "tif",
+        alias =  ["t"],
+        input =  True,
+        required =  True,
+    ),
+    dict(
+        command =  "model",
+        input =  True,
+    ),
+    dict(
+        command =  "auth",
+        input =  True,
+    ),
+    dict(
+        command =  "nano-model",
+        key = "nanoModel",
+        input =  True,
+    ),
+    dict(
+        command =  "api-root",
+        key = "apiRoot",
+        input =  True,
+        example = "http://127.0.0.1:8000"
+    ),
+    dict(
+        command =  "rate",
+        input =  True,
+        example = "5"
+    ),
+    dict(
+        command =  "sample",
+        input =  True,
+        example = "50"
+    ),
+    dict(
+        command =  "slice",
+        key = "sliceSize",
+        input =  True
+    ),
+    dict(
+        command =  "overlap",
+        input =  True
+    ),
+    dict(
+        command =  "encodings",
+        input =  True,
+        example = "png,jpeg:90,jpeg:80:420,webp:80"
+    ),
+    dict(
+        command =  "iou",
+        input =  True,
+        example = "0.5"
+    ),
+    dict(
+        command =  "min-agreement",
+        key = "minAgreement",
+        input =  True,
+        example = "0.95"
+    ),
+    ]
+
+    try:
+        opts = arger.parseArgs(argv, commands)
+    except Exception as err:
+        arger.printHelp("compare-encodings.py", commands)
+        sys.exit(2)
+
+    for key in ["sample", "sliceSize", "overlap"]:
+        if opts.get(key):
+            opts[key] = int(opts[key])
+
+    for key in ["rate", "iou", "minAgreement"]:
+        if opts.get(key):
+            opts[key] = float(opts[key])
+
+    if opts.get("encodings"):
+        opts["encodings"] = opts["encodings"].split(",")
+
+    compareOpts.__dict__.update(opts)
+
+    if compareOpts.model == None and (compareOpts.auth == None or compareOpts.nanoModel == None):
+        print("Compare with a local --model or with Nanonets through --auth and --nano-model.")
+        arger.printHelp("compare-encodings.py", commands)
+        sys.exit(2)
+
+    compare(compareOpts)
+
+class Options:
+    tif = None
+    model = None
+    auth = None
+    nanoModel = None
+    apiRoot = None
+    rate = 5.0
+    sample = 50
+    sliceSize = 500
+    overlap = 50
+    encodings = ["png", "jpeg:95", "jpeg:90", "jpeg:80:420", "webp:90", "webp:80"]
+    iou = 0.5
+    minAgreement = 0.95
+
+def compare(opts):
+    """
+    Detects a sample of tiles once per encoding and measures, against the
+    detections on the lossless PNG, the share of them found again (recall)
+    and the share of detections that were there on the PNG (precision),
+    next to the bytes per tile each encoding uploads.
+    """
+    encoders = [tileencoding.ParseEncoding(spec) for spec in opts.encodings]
+    images = sampleSlices(opts)
+    detect = remoteDetector(opts) if opts.model == None else localDetector(opts)
+
+    print("Comparing {0} encodings on {1} slices".format(len(encoders), len(images)))
+
+    reference = detect([tileencoding.EncodeImage(image, "png") for image in images])
+    pngBytes = sum(len(tileencoding.EncodeImage(image, "png")) for image in images)
+
+    print("  encoding         kB/slice   of png   recall   precision")
+
+    best = None
+    for encoder in encoders:
+        detections = detect([encoder.encode(image) for image in images])
+
+        matched, expected, found = 0, 0, 0
+        for ref, det in zip(reference, detections):
+            # Slices that failed on either side say nothing.
+            if ref == None or det == None:
+                continue
+
+            matched  = matched + matchDetections(ref, det, opts.iou)
+            expected = expected + len(ref)
+            found    = found + len(det)
+
+        recall    = matched / expected if expected > 0 else 1.0
+        precision = matched / found if found > 0 else 1.0
+        stats     = encoder.stats()
+
+        print("  {0:15}  {1:8.1f}   {2:5.1f}%   {3:5.1f}%   {4:8.1f}%".format(
+            encoder.name,
+            stats["bytesPerTile"] / 1024.0,
+            100.0 * stats["bytes"] / max(1, pngBytes),
+            100.0 * recall,
+            100.0 * precision
+        ))
+
+        if min(recall, precision) >= opts.minAgreement and (best == None or stats["bytes"] < best[1]):
+            best = (encoder, stats["bytes"])
+
+    if best != None:
+        encoder = best[0]
+        print("Smallest encoding agreeing to {0:.0f}%: --encoding {1}{2}{3}".format(
+            100.0 * opts.minAgreement,
+            encoder.format,
+            "" if encoder.quality == None else " --quality {0}".format(encoder.quality),
+            "" if encoder.subsampling == None else " --subsampling {0}".format(encoder.subsampling)
+        ))
+    else:
+        print("No encoding agrees to {0:.0f}% with png".format(100.0 * opts.minAgreement))
+
+def sampleSlices(opts):
+    """
+    opts.sample slices spread evenly over the raster, as BGR images.
+    """
+    gdal.UseExceptions();
+    ds = gdal.Open(opts.tif)
+
+    grid = tilegrid.FromDataset(ds, opts.sliceSize, opts.overlap)
+    step = max(1, len(grid.cells) // max(1, opts.sample))
+    grid = grid.subset(grid.cells[::step][:opts.sample])
+
+    return [
+        geotiff.TileToImage(tile).copy()
+        for tile in geotiff.IterTiles(ds, grid)
+    ]
+
+def localDetector(opts):
+    import cv2
+    from model import loadWeights, batchDetection
+
+    modelConfig, weights = loadWeights(opts.model)
+
+    def detect(encoded):
+        images = [
+            cv2.imdecode(np.frombuffer(image, dtype = np.uint8), cv2.IMREAD_COLOR)
+            for image in encoded
+        ]
+
+        detections = []
+        for i in range(0, len(images), 8):
+            detections.extend(batchDetection(modelConfig, weights, images[i:i + 8]))
+
+        return detections
+
+    return detect
+
+def remoteDetector(opts):
+    import nanonets as nano
+
+    def detect(encoded):
+        # A client per encoding, each is run to completion.
+        with nano.Client(opts.auth, opts.nanoModel, rate = opts.rate, apiRoot = opts.apiRoot) as client:
+            futures = [client.submit(image) for image in encoded]
+
+            detections = []
+            for future in futures:
+                res = future.result()
+                results = res.get("result", [])
+                if res.get("message") != "Success" or any(result.get("message") != "Success" for result in results):
+                    detections.append(None)
+                    continue
+
+                detections.append([
+                    prediction
+                    for result in results
+                    for prediction in result.get("prediction", [])
+                ])
+
+        return detections
+
+    return detect
+
+def matchDetections(reference, detections, iouThresh):
+    """
+    The number of reference detections matched one to one, best score
+    first, by a detection of the same label overlapping it by iouThresh.
+    """
+    unmatched = sorted(detections, key = lambda d: -d["score"])
+
+    matched = 0
+    for ref in sorted(reference, key = lambda d: -d["score"]):
+        refBox = [ref["xmin"], ref["ymin"], ref["xmax"], ref["ymax"]]
+
+        best, bestIou = None, iouThresh
+        for det in unmatched:
+            if det["label"] != ref["label"]:
+                continue
+
+            overlap = iou(refBox, [det["xmin"], det["ymin"], det["xmax"], det["ymax"]])
+            if overlap >= bestIou:
+                best, bestIou = det, overlap
+
+        if best != None:
+            unmatched.remove(best)
+            matched = matched + 1
+
+    return matched
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
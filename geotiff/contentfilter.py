@@ -0,0 +1,158 @@
+import json
+
+import numpy
+
+METHODS = ["variance", "edges", "histogram"]
+
+class ContentFilter:
+    """
+    Scores a BGR uint8 tile, as returned by geotiff.TileToImage, on how much
+    is going on in it, and tells tiles of uniform asphalt, sand or grass
+    apart so they can skip the detector. Scores are taken on every step-th
+    pixel:
+
+    variance   the largest standard deviation of the grey level within
+               block x block pixel cells
+    edges      the fraction of pixels with a grey level gradient above
+               edgeLevel
+    histogram  the Hellinger distance of the colour histogram from a
+               BackgroundModel
+
+    Tiles scoring below threshold are dropped.
+    """
+
+    def __init__(self, method = "variance", threshold = 0.0, background = None, step = 4, block = 16, edgeLevel = 24):
+        if method not in METHODS:
+            raise Exception("Unknown content filter: {0}".format(method))
+
+        if method == "histogram" and background == None:
+            raise Exception("The histogram filter needs a background model.")
+
+        self.method     = method
+        self.threshold  = threshold
+        self.background = background
+        self.step       = step
+        self.block      = block
+        self.edgeLevel  = edgeLevel
+
+        self.kept    = 0
+        self.skipped = 0
+
+    def score(self, image):
+        image = image[::self.step, ::self.step]
+
+        if self.method == "histogram":
+            return self.background.distance(image)
+
+        grey = image.mean(axis = 2, dtype = numpy.float32)
+
+        if self.method == "variance":
+            return BlockDeviation(grey, self.block)
+
+        return EdgeDensity(grey, self.edgeLevel)
+
+    def keep(self, image):
+        if self.score(image) >= self.threshold:
+            self.kept = self.kept + 1
+            return True
+
+        self.skipped = self.skipped + 1
+        return False
+
+class BackgroundModel:
+    """
+    The mean colour histogram, bins per channel and a power of two, of
+    tiles known to hold nothing of interest.
+    """
+
+    def __init__(self, histogram = None, bins = 8):
+        self.bins      = bins
+        self.histogram = histogram
+        self.count     = 0 if histogram is None else 1
+
+    def add(self, image):
+        histogram = ColourHistogram(image, self.bins)
+
+        if self.histogram is None:
+            self.histogram = histogram
+        else:
+            self.histogram = (self.histogram * self.count + histogram) / (self.count + 1)
+
+        self.count = self.count + 1
+
+    def distance(self, image):
+        histogram = ColourHistogram(image, self.bins)
+        overlap = numpy.sqrt(histogram * self.histogram).sum()
+
+        return float(numpy.sqrt(max(0.0, 1.0 - overlap)))
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump({
+                "bins": self.bins,
+                "histogram": self.histogram.tolist(),
+            }, file)
+
+def FromOptions(opts):
+    """
+    The ContentFilter asked for by the filter, filterThreshold and
+    filterBackground options of a predict script, None without a filter.
+    """
+    if opts.filter == None:
+        return None
+
+    background = None
+    if opts.filterBackground != None:
+        background = LoadBackground(opts.filterBackground)
+
+    return ContentFilter(opts.filter, opts.filterThreshold, background)
+
+def Filtered(tileFilter, callback):
+    """
+    Wraps a LoopSlices tile callback to only see the tiles tileFilter keeps.
+    Skipped tiles stay out of the journal, they are scored again on resume.
+    """
+    if tileFilter == None:
+        return callback
+
+    import geotiff
+
+    def filtered(m, xs, ys, w, h):
+        if tileFilter.keep(geotiff.TileToImage(m)):
+            return callback(m, xs, ys, w, h)
+
+    return filtered
+
+def LoadBackground(path):
+    with open(path, "r") as file:
+        model = json.load(file)
+
+    return BackgroundModel(numpy.array(model["histogram"]), model["bins"])
+
+def ColourHistogram(image, bins):
+    shift = 8 - int(numpy.log2(bins))
+    quantised = (image[:, :, :3] >> shift).astype(numpy.intp)
+
+    index = (quantised[:, :, 0] * bins + quantised[:, :, 1]) * bins + quantised[:, :, 2]
+    histogram = numpy.bincount(index.ravel(), minlength = bins ** 3).astype(numpy.float64)
+
+    return histogram / max(1, index.size)
+
+def BlockDeviation(grey, block):
+    h, w = grey.shape
+    block = max(1, min(block, h, w))
+
+    cells = grey[:h - h % block, :w - w % block].reshape(
+        h // block, block, w // block, block
+    )
+
+    return float(cells.std(axis = (1, 3)).max())
+
+def EdgeDensity(grey, edgeLevel):
+    if grey.shape[0] < 2 or grey.shape[1] < 2:
+        return 0.0
+
+    gx = numpy.abs(numpy.diff(grey, axis = 1))[:-1, :]
+    gy = numpy.abs(numpy.diff(grey, axis = 0))[:, :-1]
+
+    return float(((gx + gy) > edgeLevel).mean())
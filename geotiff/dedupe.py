@@ -0,0 +1,242 @@
+import math
+from collections import OrderedDict
+
+from featurewriter import FeatureWriter
+
+class DuplicateSuppressor:
+    """
+    Merges detections of the same object reported by overlapping tiles,
+    working on feature bounding boxes in map coordinates. Boxes are kept in
+    a grid index of cellSize map units. A new box overlapping a kept box of
+    the same label by at least iouThresh either replaces it or is dropped
+    ("nms"), or is fused into it weighted by score ("wbf").
+
+    Features are held until release() says no later tile can reach them, so
+    memory stays bounded to a band of the raster.
+    """
+
+    def __init__(self, cellSize, iouThresh = 0.5, mode = "nms"):
+        if mode not in ["nms", "wbf"]:
+            raise Exception("Unknown duplicate suppression mode: {0}".format(mode))
+
+        self.cellSize  = cellSize
+        self.iouThresh = iouThresh
+        self.mode      = mode
+
+        self.cells   = {}
+        self.entries = OrderedDict()
+        self.seq     = 0
+
+        self.added      = 0
+        self.suppressed = 0
+
+    def add(self, feature):
+        box = featureBox(feature)
+        label = feature["properties"].get("label")
+        score = feature["properties"].get("score", 0)
+
+        self.added = self.added + 1
+
+        matches = [
+            entry for entry in self.candidates(box)
+            if entry.label == label and iou(entry.box, box) >= self.iouThresh
+        ]
+
+        if len(matches) == 0:
+            self.insert(Entry(feature, box, label, score))
+            return
+
+        self.suppressed = self.suppressed + 1
+
+        if self.mode == "wbf":
+            best = max(matches, key = lambda entry: iou(entry.box, box))
+            best.fuse(box, score)
+            return
+
+        best = max(matches, key = lambda entry: entry.score)
+        if score > best.score:
+            for entry in matches:
+                self.remove(entry)
+
+            self.suppressed = self.suppressed + len(matches) - 1
+            self.insert(Entry(feature, box, label, score))
+
+    def release(self, frontier, descending = True):
+        """
+        Returns, in insertion order, the features lying entirely beyond the
+        sweep frontier, a map y coordinate that later detections can no
+        longer cross. With descending the sweep moves towards smaller y,
+        as rows do on a north-up raster.
+        """
+        done = []
+        for entry in self.entries.values():
+            x0, y0, x1, y1 = entry.box
+            if (y0 > frontier) if descending else (y1 < frontier):
+                done.append(entry)
+
+        for entry in done:
+            self.remove(entry)
+
+        return [entry.toFeature() for entry in done]
+
+    def releaseAll(self):
+        done = list(self.entries.values())
+        for entry in done:
+            self.remove(entry)
+
+        return [entry.toFeature() for entry in done]
+
+    def candidates(self, box):
+        seen = set()
+        for cell in self.cellsOf(box):
+            for entry in self.cells.get(cell, []):
+                if entry.seq not in seen:
+                    seen.add(entry.seq)
+                    yield entry
+
+    def cellsOf(self, box):
+        x0, y0, x1, y1 = box
+        size = self.cellSize
+
+        return [
+            (cx, cy)
+            for cx in range(int(math.floor(x0 / size)), int(math.floor(x1 / size)) + 1)
+            for cy in range(int(math.floor(y0 / size)), int(math.floor(y1 / size)) + 1)
+        ]
+
+    def insert(self, entry):
+        entry.seq = self.seq
+        self.seq = self.seq + 1
+
+        entry.cells = self.cellsOf(entry.box)
+        for cell in entry.cells:
+            self.cells.setdefault(cell, []).append(entry)
+
+        self.entries[entry.seq] = entry
+
+    def remove(self, entry):
+        for cell in entry.cells:
+            held = self.cells[cell]
+            held.remove(entry)
+            if len(held) == 0:
+                del self.cells[cell]
+
+        del self.entries[entry.seq]
+
+class Entry:
+    def __init__(self, feature, box, label, score):
+        self.feature = feature
+        self.box     = box
+        self.label   = label
+        self.score   = score
+        self.weight  = score
+        self.fused   = False
+
+        self.seq   = None
+        self.cells = []
+
+    def fuse(self, box, score):
+        total = self.weight + score
+        if total <= 0:
+            return
+
+        # The index cells are kept, a fused box only moves by a fraction of
+        # an object and stays within reach of the neighbouring cells.
+        self.box = [
+            (a * self.weight + b * score) / total
+            for a, b in zip(self.box, box)
+        ]
+        self.weight = total
+        self.score  = max(self.score, score)
+        self.fused  = True
+
+    def toFeature(self):
+        if not self.fused:
+            return self.feature
+
+        x0, y0, x1, y1 = featureBox(self.feature)
+        nx0, ny0, nx1, ny1 = self.box
+
+        ring = [
+            [nx0 if x == x0 else nx1, ny0 if y == y0 else ny1]
+            for x, y in self.feature["geometry"]["coordinates"][0]
+        ]
+
+        feature = dict(self.feature)
+        feature["geometry"] = dict(self.feature["geometry"], coordinates = [ring])
+        feature["properties"] = dict(self.feature["properties"], score = self.score)
+
+        return feature
+
+class TileMerger:
+    """
+    Feeds the features of tiles delivered in grid order through a
+    DuplicateSuppressor and hands the finished ones on to a FeatureWriter.
+    """
+
+    def __init__(self, writer, gt, sliceSize, iouThresh = 0.5, mode = "nms", streaming = True):
+        self.writer    = writer
+        self.gt        = gt
+        self.streaming = streaming
+        self.lastY     = None
+
+        self.suppressor = DuplicateSuppressor(
+            sliceSize * max(abs(gt[1]), abs(gt[5])),
+            iouThresh,
+            mode
+        )
+
+    def add(self, ys, features):
+        # A new row of tiles starts at ys, nothing above it can be reached
+        # by later tiles.
+        if self.streaming and ys != self.lastY:
+            frontier = self.gt[3] + ys * self.gt[5]
+            self.writer.add(self.suppressor.release(frontier, self.gt[5] < 0))
+            self.lastY = ys
+
+        for feature in features:
+            self.suppressor.add(feature)
+
+    def close(self):
+        self.writer.add(self.suppressor.releaseAll())
+
+        print("Suppressed {0} duplicate detections of {1}".format(
+            self.suppressor.suppressed, self.suppressor.added
+        ))
+
+def OpenWriter(output, ds, grid, tileJournal, mode = None, iouThresh = 0.5, streaming = True):
+    """
+    The FeatureWriter for a prediction run, and with a dedupe mode the
+    TileMerger in front of it, None otherwise. Tiles done by an earlier run
+    go through the merger again so duplicates across the resume point are
+    caught too.
+    """
+    if mode == None:
+        return FeatureWriter(output, tileJournal.features), None
+
+    writer = FeatureWriter(output)
+    merger = TileMerger(writer, ds.GetGeoTransform(), grid.sliceSize, iouThresh, mode, streaming)
+
+    for tileId, features in tileJournal.tiles:
+        xs, ys, w, h = grid.window(*grid.cellOfId(tileId))
+        merger.add(ys, features)
+
+    return writer, merger
+
+def featureBox(feature):
+    ring = feature["geometry"]["coordinates"][0]
+    xs = [point[0] for point in ring]
+    ys = [point[1] for point in ring]
+
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+def iou(a, b):
+    iw = min(a[2], b[2]) - max(a[0], b[0])
+    ih = min(a[3], b[3]) - max(a[1], b[1])
+    if iw <= 0 or ih <= 0:
+        return 0.0
+
+    intersect = iw * ih
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersect
+
+    return intersect / union if union > 0 else 0.0
@@ -5,6 +5,7 @@ from osgeo import gdal, ogr, osr
 import sys, getopt
 
 import geotiff
+import georef
 import json
 import numpy as np
 
@@ -73,24 +74,29 @@ def expandImages(opts):
     if not os.path.exists(opts.output):
         os.makedirs(opts.output)
 
-    grid = {}
+    shapes = []
+    scores = []
     for feature in geojson["features"]:
-        boxes = geotiff.getPixelBoxesFromShapes(
-            ds,
-            feature["geometry"]["coordinates"],
-            score = feature["properties"]["score"]
-        )
+        rings = feature["geometry"]["coordinates"]
+
+        shapes.extend(rings)
+        scores.extend([feature["properties"]["score"]] * len(rings))
+
+    boxes = georef.ShapesToPixelBoxes(ds.GetGeoTransform(), shapes).tolist()
+
+    grid = {}
+    for (xmin, ymin, xmax, ymax), score in zip(boxes, scores):
+        box = geotiff.Box(xmin, ymin, xmax, ymax, score)
 
-        for box in boxes:
-            x = int(box.xmin / 500)
-            y = int(box.ymin / 500)
-            col = grid.get(x, {})
-            row = col.get(y, [])
+        x = int(box.xmin / 500)
+        y = int(box.ymin / 500)
+        col = grid.get(x, {})
+        row = col.get(y, [])
 
-            grid[x]    = col
-            grid[x][y] = row
+        grid[x]    = col
+        grid[x][y] = row
 
-            row.append(box)
+        row.append(box)
 
     stored = 0
     for col in grid:
@@ -117,7 +123,8 @@ def byImage(opts, ds, col, row, boxes, stored):
     slice = geotiff.SliceDataset(ds, nx, ny, width, height)
     memImage, c = geotiff.DatasetToJPEG(slice, output = "./tempslice.jpg")
 
-    image = cv2.imread(memImage.getPath())
+    with memImage:
+        image = cv2.imread(memImage.getPath())
     thickness = 2
 
     for box in boxes:
@@ -164,6 +171,7 @@ def byAnnotation(opts, ds, col, row, boxes, stored):
             "{1} annotation-{0}.jpg".format(stored, score)
         )
         memImage, c = geotiff.DatasetToJPEG(slice, output = outputFile)
+        memImage.release()
 
         stored = stored + 1
 
@@ -0,0 +1,68 @@
+import json
+import os
+import time
+
+class FeatureWriter:
+    """
+    Streams features to a GeoJSONSeq file next to the output, one feature
+    per line, instead of rewriting the whole collection on every hit. The
+    FeatureCollection at output is rebuilt from it every checkpointSeconds
+    and on close, through a temporary file so readers never see it half
+    written.
+    """
+
+    def __init__(self, output, features = None, flushEvery = 100, checkpointSeconds = 30):
+        self.output            = output
+        self.seqPath           = os.path.splitext(output)[0] + ".geojsons"
+        self.flushEvery        = flushEvery
+        self.checkpointSeconds = checkpointSeconds
+
+        self.count      = 0
+        self.unflushed  = 0
+        self.checkpointed = time.time()
+
+        self.file = open(self.seqPath, "w")
+        self.add([] if features is None else features)
+
+    def add(self, features):
+        for feature in features:
+            self.file.write(json.dumps(feature))
+            self.file.write("\n")
+
+        self.count = self.count + len(features)
+        self.unflushed = self.unflushed + len(features)
+
+        if self.unflushed >= self.flushEvery:
+            self.flush()
+
+        if time.time() - self.checkpointed >= self.checkpointSeconds:
+            self.checkpoint()
+
+    def flush(self):
+        self.file.flush()
+        self.unflushed = 0
+
+    def checkpoint(self):
+        self.flush()
+
+        temp = self.output + ".tmp"
+        with open(self.seqPath, "r") as seq, open(temp, "w") as collection:
+            # Same layout as json.dumps of the FeatureCollection dict.
+            collection.write('{"type": "FeatureCollection", "features": [')
+
+            first = True
+            for line in seq:
+                if not first:
+                    collection.write(", ")
+
+                collection.write(line.rstrip("\n"))
+                first = False
+
+            collection.write("]}")
+
+        os.replace(temp, self.output)
+        self.checkpointed = time.time()
+
+    def close(self):
+        self.checkpoint()
+        self.file.close()
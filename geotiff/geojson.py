@@ -1,4 +1,4 @@
-import geotiff
+import georef
 
 def newCollection():
     return {
@@ -7,41 +7,44 @@ def newCollection():
     }
 
 def addFeatureFromBoundingBox(geojson, ds, bbox, properties = {}):
-    gt = ds.GetGeoTransform()
-
-    cols = ds.RasterXSize
-    rows = ds.RasterYSize
-
-    coords = geotiff.GetCoordinatesFromPixelBox(
-        gt,
-        cols,
-        rows,
-        bbox["x"],
-        bbox["y"],
-        bbox["width"],
-        bbox["height"],
-    )
-
-    topLeft     = [coords[0], coords[1]]
-    topRight    = [coords[2], coords[1]]
-    bottomLeft  = [coords[0], coords[3]]
-    bottomRight = [coords[2], coords[3]]
-
-    geojson["features"].append({
-        "type": "Feature",
-        "geometry": {
-            "type": "Polygon",
-            "coordinates": [
-                [
-                    topLeft,
-                    topRight,
-                    bottomRight,
-                    bottomLeft
+    return addFeaturesFromBoundingBoxes(
+        geojson,
+        ds,
+        [[bbox["x"], bbox["y"], bbox["width"], bbox["height"]]],
+        [properties]
+    )[0]
+
+def addFeaturesFromBoundingBoxes(geojson, ds, boxes, properties):
+    """
+    Adds one polygon feature per x, y, width, height pixel box of ds,
+    georeferenced in one batch. Returns the polygon corners of each box.
+    """
+    coords = georef.PixelBoxesToCoords(ds.GetGeoTransform(), boxes).tolist()
+
+    added = []
+    for (left, top, right, bottom), props in zip(coords, properties):
+        topLeft     = [left, top]
+        topRight    = [right, top]
+        bottomLeft  = [left, bottom]
+        bottomRight = [right, bottom]
+
+        geojson["features"].append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [
+                    [
+                        topLeft,
+                        topRight,
+                        bottomRight,
+                        bottomLeft
+                    ]
                 ]
-            ]
-        },
+            },
 
-        "properties": properties
-    })
+            "properties": props
+        })
 
-    return [topLeft, topRight, bottomRight, bottomLeft]
+        added.append([topLeft, topRight, bottomRight, bottomLeft])
+
+    return added
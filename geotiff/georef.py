@@ -0,0 +1,77 @@
+import numpy
+
+# Pixel positions closer than this to a whole pixel are snapped to it
+# before truncating, so float noise from a map -> pixel round trip does not
+# move a box edge by one pixel.
+snapTolerance = 1e-6
+
+def PixelToMap(gt, px, py):
+    px = numpy.asarray(px, dtype = numpy.float64)
+    py = numpy.asarray(py, dtype = numpy.float64)
+
+    return (
+        gt[0] + px * gt[1] + py * gt[2],
+        gt[3] + px * gt[4] + py * gt[5],
+    )
+
+def MapToPixel(gt, mx, my):
+    mx = numpy.asarray(mx, dtype = numpy.float64) - gt[0]
+    my = numpy.asarray(my, dtype = numpy.float64) - gt[3]
+
+    det = gt[1] * gt[5] - gt[2] * gt[4]
+
+    return (
+        (gt[5] * mx - gt[2] * my) / det,
+        (gt[1] * my - gt[4] * mx) / det,
+    )
+
+def PixelBoxesToCoords(gt, boxes):
+    """
+    Converts an (N, 4) array of x, y, width, height pixel boxes into an
+    (N, 4) array of map coordinates, laid out like GetCoordinatesFromPixelBox:
+    [left, top, right, bottom].
+    """
+    boxes = numpy.asarray(boxes, dtype = numpy.float64).reshape(-1, 4)
+
+    x, y, width, height = boxes.T
+
+    coords = numpy.empty(boxes.shape, dtype = numpy.float64)
+    coords[:, 0], coords[:, 1] = PixelToMap(gt, x, y)
+    coords[:, 2], coords[:, 3] = PixelToMap(gt, x + width, y + height)
+
+    return coords
+
+def ShapesToPixelBoxes(gt, shapes):
+    """
+    Converts polygon rings, each a list of [x, y] map coordinates, into an
+    (N, 4) integer array of xmin, ymin, xmax, ymax pixel boxes, one per ring.
+    """
+    lengths = numpy.array([len(shape) for shape in shapes], dtype = numpy.int64)
+    if len(lengths) == 0:
+        return numpy.zeros((0, 4), dtype = numpy.int64)
+
+    if numpy.all(lengths == lengths[0]):
+        vertices = numpy.asarray(shapes, dtype = numpy.float64)[:, :, :2].reshape(-1, 2)
+    else:
+        vertices = numpy.concatenate(
+            [numpy.asarray(shape, dtype = numpy.float64)[:, :2] for shape in shapes]
+        )
+
+    px, py = MapToPixel(gt, vertices[:, 0], vertices[:, 1])
+
+    starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+
+    boxes = numpy.stack([
+        numpy.minimum.reduceat(px, starts),
+        numpy.minimum.reduceat(py, starts),
+        numpy.maximum.reduceat(px, starts),
+        numpy.maximum.reduceat(py, starts),
+    ], axis = 1)
+
+    return SnapTrunc(boxes)
+
+def SnapTrunc(values):
+    nearest = numpy.rint(values)
+    snapped = numpy.where(numpy.abs(values - nearest) < snapTolerance, nearest, values)
+
+    return numpy.trunc(snapped).astype(numpy.int64)
@@ -6,19 +6,20 @@ from osgeo import gdal, ogr, osr
 import sys, getopt
 
 import geotiff
+import tilegrid
+import journal
+import pipeline
+import dedupe
 import time
 import math
-from decimal import Decimal
 
-from utils.utils import get_yolo_boxes, makedirs
-from utils.bbox import draw_boxes
-from keras.models import load_model
-
-from model import loadWeights, imageDetection
+import inference
+import replicas
+import contentfilter
 import numpy as np
 import json
 
-from geojson import newCollection, addFeatureFromBoundingBox
+from geojson import newCollection, addFeaturesFromBoundingBoxes
 
 def main(argv):
     predOpts = PredictionOptions()
@@ -32,6 +33,27 @@ def main(argv):
             "ignore-negatives", 
             "temp-slice=", 
             "output=",
+            "reader=",
+            "workers=",
+            "unordered",
+            "min-valid=",
+            "shard=",
+            "plan=",
+            "save-plan=",
+            "journal=",
+            "resume",
+            "batch-size=",
+            "pipeline",
+            "stage-workers=",
+            "queue-size=",
+            "dedupe=",
+            "dedupe-iou=",
+            "server=",
+            "replicas=",
+            "filter=",
+            "filter-threshold=",
+            "filter-background=",
+            "replica-threads=",
             "verbose"
         ])
     except getopt.GetoptError:
@@ -56,27 +78,89 @@ def main(argv):
             predOpts.output = arg
         elif opt == "--temp-slice":
             predOpts.tempSlice = arg
+        elif opt == "--reader":
+            predOpts.reader = arg
+        elif opt == "--workers":
+            predOpts.workers = int(arg)
+        elif opt == "--unordered":
+            predOpts.ordered = False
+        elif opt == "--min-valid":
+            predOpts.minValid = float(arg)
+        elif opt == "--shard":
+            predOpts.shard = tilegrid.ParseShard(arg)
+        elif opt == "--plan":
+            predOpts.plan = arg
+        elif opt == "--save-plan":
+            predOpts.savePlan = arg
+        elif opt == "--journal":
+            predOpts.journal = arg
+        elif opt == "--resume":
+            predOpts.resume = True
+        elif opt == "--batch-size":
+            predOpts.batchSize = int(arg)
+        elif opt == "--pipeline":
+            predOpts.pipeline = True
+        elif opt == "--stage-workers":
+            predOpts.stageWorkers = int(arg)
+        elif opt == "--queue-size":
+            predOpts.queueSize = int(arg)
+        elif opt == "--dedupe":
+            predOpts.dedupe = arg
+        elif opt == "--dedupe-iou":
+            predOpts.dedupeIou = float(arg)
+        elif opt == "--server":
+            predOpts.server = arg
+        elif opt == "--replicas":
+            predOpts.replicas = int(arg)
+        elif opt == "--replica-threads":
+            predOpts.replicaThreads = int(arg)
+        elif opt == "--filter":
+            predOpts.filter = arg
+        elif opt == "--filter-threshold":
+            predOpts.filterThreshold = float(arg)
+        elif opt == "--filter-background":
+            predOpts.filterBackground = arg
         elif opt == "--verbose":
             predOpts.verbose = True
 
-    if (predOpts.tif == None or predOpts.model == None):
-        print('predict.py -tif <geotiff.tif> --model <config.json>')
+    if (predOpts.tif == None or (predOpts.model == None and predOpts.server == None)):
+        print('predict.py -tif <geotiff.tif> --model <config.json> | --server <socket>')
         sys.exit(2)
 
     runPrediction(predOpts)
 
 class PredictionOptions:
-    tempSlice = "./tempslice.jpg"
+    tempSlice = None
     output = "./geotiff-predict-results.json"
     tif = None
     model = None
     sliceSize = 500
     overlap = 50
     ignoreNegatives = False
+    reader = "strip"
+    workers = 0
+    ordered = True
+    minValid = 0.0
+    shard = None
+    plan = None
+    savePlan = None
+    journal = None
+    resume = False
+    batchSize = 8
+    pipeline = False
+    stageWorkers = 2
+    queueSize = 16
+    dedupe = None
+    dedupeIou = 0.5
+    server = None
+    replicas = 0
+    replicaThreads = None
+    filter = None
+    filterThreshold = 0.0
+    filterBackground = None
     verbose = False
 
 def runPrediction(opts):
-    modelConfig, weights = loadWeights(opts.model)
     gdal.UseExceptions();
     
     def printv(*args):
@@ -85,84 +169,259 @@ def runPrediction(opts):
 
     ds = gdal.Open(opts.tif)
 
-    geojson = newCollection() 
+    if opts.plan != None:
+        grid = tilegrid.Load(opts.plan)
+    else:
+        grid = tilegrid.FromDataset(ds, opts.sliceSize, opts.overlap)
+
+    if opts.shard != None:
+        grid = grid.shard(*opts.shard)
+
+    if opts.savePlan != None:
+        grid.save(opts.savePlan)
+        print("Saved plan of {0} slices to {1}".format(len(grid), opts.savePlan))
+        return
+
+    # A running inference-server.py has the model loaded already, otherwise
+    # TensorFlow is only imported here.
+    if opts.server != None:
+        client = inference.InferenceClient(opts.server)
+        print("Using inference server at {0}".format(opts.server))
+
+        detectBatch = client.detect
+    elif opts.replicas > 0:
+        pool = replicas.ReplicaPool(opts.model, opts.replicas, opts.replicaThreads)
+        print("Started {0} model replicas with {1} threads each".format(len(pool), pool.threads))
+
+        detectBatch = pool.detect
+    else:
+        from model import loadWeights, batchDetection
+
+        modelConfig, weights = loadWeights(opts.model)
+
+        def detectBatch(images):
+            return batchDetection(modelConfig, weights, images)
 
     output = opts.output
-    hits = []
 
-    sliceSize = opts.sliceSize
-    overlap = opts.overlap
+    journalPath = output + ".journal" if opts.journal == None else opts.journal
+    tileJournal = journal.Journal(journalPath, grid.key, resume = opts.resume)
+    writer, merger = dedupe.OpenWriter(
+        output, ds, grid, tileJournal, opts.dedupe, opts.dedupeIou, opts.ordered
+    )
+    if opts.resume:
+        grid = journal.RemainingGrid(grid, tileJournal)
+
+        print("Resuming with {0} slices done, {1} features".format(
+            len(tileJournal.completed), len(tileJournal.features)
+        ))
+
+    sliceSize = grid.sliceSize
+    overlap = grid.overlap
 
     rasterX = ds.RasterXSize
     rasterY = ds.RasterYSize
-    yCeil = int(math.ceil(rasterY / sliceSize))
-    xCeil = int(math.ceil(rasterX / sliceSize))
 
     initialCoords = geotiff.GetCoords(ds)
-    printv("Slice length: {0}x{1}, Raster size: {2}x{3}, origin coords: {4}, {5}".format(
-        xCeil, yCeil, rasterX, rasterY, initialCoords[0], initialCoords[1]
+    printv("Slice length: {0}x{1}, Raster size: {2}x{3}, origin coords: {4}, {5}, planned slices: {6}".format(
+        grid.columns, grid.rows, rasterX, rasterY, initialCoords[0], initialCoords[1],
+        len(grid)
     ))
 
     class Memo:
         sliced = 0
+        batch = []
 
     memo = Memo()
-    def callback(m, xs, ys, w, h):
-        memImage, coords = geotiff.DatasetToJPEG(m, opts.tempSlice)
+    def sliceImage(m, xs, ys, w, h):
+        coords = geotiff.GetCoords(m)
 
         printv("Slicing: {0}x{1} {2}w {3}h, coords: [{4}, {5}]".format(
             xs, ys, w, h, coords[0], coords[1]
         ))
 
-        annotations = imageDetection(
-            modelConfig,
-            weights,
-            memImage.getPath()
-        )
+        # Only dump the slice to disk when explicitly asked to.
+        if opts.tempSlice != None:
+            geotiff.DatasetToJPEG(m, opts.tempSlice)[0].release()
 
-        hits = 0
+        # The tile's pixels are only valid during the callback, keep a copy
+        # for the detector.
+        return geotiff.TileToImage(m).copy()
+
+    def callback(m, xs, ys, w, h):
+        memo.batch.append((m, sliceImage(m, xs, ys, w, h)))
+        if len(memo.batch) >= opts.batchSize:
+            flush()
+
+    def flush():
+        batch = memo.batch
+        memo.batch = []
+
+        batchAnnotations = detectBatch([image for m, image in batch])
+
+        for (m, image), annotations in zip(batch, batchAnnotations):
+            addAnnotations(m, annotations)
+
+    def addAnnotations(m, annotations):
+        geojson = newCollection()
+
+        boxes = []
+        properties = []
         for annotation in annotations:
             if annotation["score"] < 0 and opts.ignoreNegatives:
                 print("Ignored a negative score detection.")
                 continue
 
-            addedCoords = addFeatureFromBoundingBox(geojson, m, {
-                "x": annotation["xmin"],
-                "y": annotation["ymin"],
-                "width": annotation["xmax"] - annotation["xmin"],
-                "height": annotation["ymax"] - annotation["ymin"]
-            },
-                {
+            boxes.append([
+                annotation["xmin"],
+                annotation["ymin"],
+                annotation["xmax"] - annotation["xmin"],
+                annotation["ymax"] - annotation["ymin"]
+            ])
+            properties.append({
                 "label": annotation["label"],
-                "score": Decimal(annotation["score"] * 1)
-            }
-            )
+                "score": float(annotation["score"])
+            })
 
+        for addedCoords in addFeaturesFromBoundingBoxes(geojson, m, boxes, properties):
             printv("Annotation at", addedCoords)
-            hits = hits + 1
 
+        tileJournal.record(m.id, geojson["features"])
+        if merger != None:
+            merger.add(m.y, geojson["features"])
+        else:
+            writer.add(geojson["features"])
+
+        hits = len(boxes)
         if hits > 0:
-            print(hits, "hits at {0}x{1}".format(xs,ys))
-            with open(output, "w") as fileOutput:
-                fileOutput.write(json.dumps(geojson, cls=DecimalEncoder))
+            print(hits, "hits at {0}x{1}".format(m.x, m.y))
 
         memo.sliced = memo.sliced + 1
         if memo.sliced % 100 == 99:
-            print("Sliced another 100, at", xs, ys)
+            print("Sliced another 100, at", m.x, m.y)
 
-    geotiff.LoopSlices(
-        ds, sliceSize, overlap,
-        callback
-    )
+    tileFilter = contentfilter.FromOptions(opts)
+
+    def loopSlices(callback):
+        return geotiff.LoopSlices(
+            ds, sliceSize, overlap,
+            contentfilter.Filtered(tileFilter, callback),
+            reader = opts.reader,
+            tiles = True,
+            workers = opts.workers,
+            ordered = opts.ordered,
+            minValid = opts.minValid,
+            grid = grid
+        )
+
+    # Replicas need a batch in flight each, which only the pipeline does.
+    # The server has one connection and runs one batch at a time.
+    if opts.replicas > 0 or (opts.pipeline and opts.server != None):
+        stats = runPipeline(opts, [
+            pipeline.Stage(
+                "infer", remoteInfer(detectBatch),
+                workers = 1 if opts.server != None else opts.replicas,
+                batchSize = opts.batchSize
+            ),
+        ], loopSlices, sliceImage, addAnnotations)
+    elif opts.pipeline:
+        stats = runPipeline(opts, localStages(opts, modelConfig, weights), loopSlices, sliceImage, addAnnotations)
+    else:
+        stats = loopSlices(callback)
+        flush()
+
+    # Slices the content filter drops are counted as sliced before it.
+    filtered = 0 if tileFilter == None else tileFilter.skipped
+    print("Predicted {0} slices, skipped {1} empty slices".format(
+        stats["sliced"] - filtered, stats["skipped"]
+    ))
+
+    if tileFilter != None:
+        print("Content filter passed {0} slices, skipped {1}".format(
+            tileFilter.kept, tileFilter.skipped
+        ))
+
+    if opts.server != None:
+        client.close()
+    elif opts.replicas > 0:
+        for replica in pool.stats():
+            print("Replica {0} on cores {1}: {2} slices, {3:.1f}s busy".format(
+                replica["replica"], replica["cores"], replica["images"], replica["busy"]
+            ))
+
+        pool.close()
+    else:
+        from model import batchBuffer
+
+        buffers = batchBuffer.stats()
+        print("Preprocessed {0} slices in {1:.1f} MiB of float32 buffers, {2:.1f} MiB less than float64 preprocessing".format(
+            buffers["images"], buffers["allocated"] / 2**20, (buffers["avoided"] - buffers["allocated"]) / 2**20
+        ))
+
+    if merger != None:
+        merger.close()
+
+    writer.close()
+    tileJournal.close()
+
+def localStages(opts, modelConfig, weights):
+    from model import preprocessImage, predictBatch, decodeOutputs
+
+    def preprocess(item):
+        m, image = item
+        return m, image.shape, preprocessImage(image)
+
+    def infer(items):
+        outputs = predictBatch(weights, [inputs for m, shape, inputs in items])
+        return [(m, shape, yolos) for (m, shape, inputs), yolos in zip(items, outputs)]
+
+    def decode(item):
+        m, shape, yolos = item
+        return m, decodeOutputs(modelConfig, yolos, shape[0], shape[1])
+
+    return [
+        pipeline.Stage("preprocess", preprocess, workers = opts.stageWorkers),
+        pipeline.Stage("infer", infer, batchSize = opts.batchSize),
+        pipeline.Stage("decode", decode, workers = opts.stageWorkers),
+    ]
 
-    with open(output, "w") as fileOutput:
-        fileOutput.write(json.dumps(geojson, cls=DecimalEncoder))
+def remoteInfer(detectBatch):
+    def infer(items):
+        batchAnnotations = detectBatch([image for m, image in items])
+        return [(m, annotations) for (m, image), annotations in zip(items, batchAnnotations)]
+
+    return infer
+
+def runPipeline(opts, stages, loopSlices, sliceImage, addAnnotations):
+    def write(item):
+        addAnnotations(*item)
+
+    pipe = pipeline.Pipeline(stages + [
+        pipeline.Stage("write", write, ordered = True),
+    ], queueSize = opts.queueSize)
+
+    class Memo:
+        sliced = 0
+
+    memo = Memo()
+    def produce(put):
+        def enqueue(m, xs, ys, w, h):
+            put((m, sliceImage(m, xs, ys, w, h)))
+
+            memo.sliced = memo.sliced + 1
+            if opts.verbose and memo.sliced % 100 == 0:
+                print("Queue depths:", pipe.depths())
+
+        return loopSlices(enqueue)
+
+    stats = pipe.run(produce)
+
+    for stage in pipe.stats():
+        print("Stage {0}: {1} slices, {2:.1f}s busy".format(
+            stage["stage"], stage["processed"], stage["busy"]
+        ))
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, Decimal):
-            return float(o)
-        return super(DecimalEncoder, self).default(o)
+    return stats
 
 if __name__ == "__main__":
    main(sys.argv[1:])
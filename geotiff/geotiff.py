@@ -1,25 +1,103 @@
-from decimal import Decimal
-from osgeo import gdal, ogr, osr
-import math
+from osgeo import gdal, gdal_array, ogr, osr
+import numpy
 from collections import namedtuple
 
+import georef
+import occupancy
+import tilegrid
+import tilecache
+
 class MemImage:
     path        = None
     coordsPath  = None
-    invalidated = False
 
     def __init__(self, path, coordsPath):
         self.path       = path
         self.coordsPath = coordsPath
 
     def getPath(self):
-        if self.invalidated:
-            raise Exception("Mem image index has been replaced.")
-
         return self.path
 
-    def invalidate(self):
-        self.invalidated = True
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class Tile:
+    """
+    A slice of a raster as a (bands, rows, columns) array in the source's
+    native data type, with its pixel offsets and geotransform. Offers the
+    parts of the gdal.Dataset interface the slice consumers use, a real
+    dataset is only created through ToDataset.
+    """
+
+    def __init__(self, data, x, y, geoTransform, projection, id = None):
+        self.data         = data
+        self.x            = x
+        self.y            = y
+        self.geoTransform = geoTransform
+        self.projection   = projection
+        self.id           = id
+
+    @property
+    def width(self):
+        return self.data.shape[2]
+
+    @property
+    def height(self):
+        return self.data.shape[1]
+
+    @property
+    def RasterXSize(self):
+        return self.width
+
+    @property
+    def RasterYSize(self):
+        return self.height
+
+    @property
+    def RasterCount(self):
+        return self.data.shape[0]
+
+    def GetGeoTransform(self):
+        return self.geoTransform
+
+    def GetProjection(self):
+        return self.projection
+
+    def ToDataset(self):
+        dst_ds = gdal_array.OpenArray(self.data)
+        dst_ds.SetGeoTransform(self.geoTransform)
+        dst_ds.SetProjection(self.projection)
+
+        return dst_ds
+
+def TileToImage(tile, bandCount = 3):
+    """
+    Returns the first bandCount bands of a tile as a (rows, columns, bands)
+    uint8 image in OpenCV's BGR order, the same pixels cv2.imread gives for
+    the tile encoded by GTifToJPEG. A view on the tile when it is 8-bit.
+    """
+    data = tile.data[:bandCount]
+    if data.dtype != numpy.uint8:
+        # Same conversion as gdal.Translate -ot Byte: round and clamp.
+        data = numpy.clip(numpy.rint(data), 0, 255).astype(numpy.uint8)
+
+    return data[::-1].transpose(1, 2, 0)
+
+def TileGeoTransform(gt, x, y):
+    return [
+        gt[0] + x * gt[1] + y * gt[2],
+        gt[1],
+        gt[2],
+        gt[3] + x * gt[4] + y * gt[5],
+        gt[4],
+        gt[5],
+    ]
 
 def SliceDatasetToFile(ds, output, x, y, width, height):
     driver = gdal.GetDriverByName("GTiff")
@@ -49,32 +127,60 @@ def SliceDataset(ds, x, y, width, height):
 
     return WriteChunkedGTiff(ds, dst_ds, x, y, width, height)
 
+def ArrayToDataset(ds, data, x, y):
+    bands, height, width = data.shape
+
+    driver = gdal.GetDriverByName("MEM")
+    dst_ds = driver.Create("", 
+       width, 
+       height, 
+       bands, 
+       gdal.GDT_Float32
+    )
+
+    for bandIdx in range(1, bands + 1):
+        dst_ds.GetRasterBand(bandIdx).WriteArray(data[bandIdx - 1])
+
+    SetSliceGeoreference(ds, dst_ds, x, y, width, height)
+
+    return dst_ds
+
+coordTransforms = {}
 def GetCoords(ds):
     geo = ds.GetGeoTransform()
 
     originX = geo[0]
     originY = geo[3]
 
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(ds.GetProjection())
+    wkt = ds.GetProjection()
+    ct = coordTransforms.get(wkt)
+    if ct is None:
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(wkt)
 
-    srsLatLong = srs.CloneGeogCS()
-    ct = osr.CoordinateTransformation(srs, srsLatLong)
+        srsLatLong = srs.CloneGeogCS()
+        ct = osr.CoordinateTransformation(srs, srsLatLong)
+        coordTransforms[wkt] = ct
 
     return ct.TransformPoint(originX, originY)
 
-def DatasetToJPEG(ds, output = None):
+def DatasetToJPEG(ds, output = None, cache = None, key = None):
+    """
+    Encodes the first three bands of ds to output, or without one into the
+    tile cache. Returns the image handle and the origin coordinates. The
+    handle has to be released, or used in a with block, once the path is
+    no longer needed, an unreleased cached image is never unlinked.
+    """
+    if isinstance(ds, Tile):
+        ds = ds.ToDataset()
+
     coords = GetCoords(ds)
-    memImage = GTifToJPEG(ds, 3, output)
+    memImage = GTifToJPEG(ds, 3, output, cache, key)
 
     return (memImage, coords)
 
-memoLimit = 10
-memo = {
-    "at": 0,
-    "list": [None] * memoLimit
-}
-def GTifToJPEG(tif, bandCount, output = None):
+memCache = tilecache.TileCache()
+def GTifToJPEG(tif, bandCount, output = None, cache = None, key = None):
     options = [
         "-ot Byte",
         "-of PNG",
@@ -83,34 +189,31 @@ def GTifToJPEG(tif, bandCount, output = None):
     for bandIdx in range(1, bandCount + 1):
         options.append("-b {0}".format(bandIdx))
 
+    # In memory outputs go through the tile cache, the returned handle has
+    # to be released by the caller.
     if (output == None):
-        idx = memo["at"] % memoLimit
+        cache = memCache if cache is None else cache
+        return cache.encode(tif, " ".join(options), key)
 
-        output = "/vsimem/inmemjpeg{0}.jpg".format(idx)
-        memImage = MemImage(output, output + ".aux.xml")
-
-        memo["list"][idx] = memImage
-        memo["at"] = (idx + 1) % memoLimit
-        prevImage = memo["list"][memo["at"]]
-        if prevImage is not None:
-            prevImage.invalidate()
-    else:
-        memImage = MemImage(output, output + ".aux.xml")
+    memImage = MemImage(output, output + ".aux.xml")
 
     gdal.Translate(output, tif, options = " ".join(options))
     return memImage
 
 def WriteChunkedGTiff(ds, dst_ds, x, y, width, height):
-    gt = ds.GetGeoTransform()
-    cols = ds.RasterXSize
-    rows = ds.RasterYSize
-
     # Write all raster layers to new file
     for bandIdx in range(1, ds.RasterCount + 1):
         band = ds.GetRasterBand(bandIdx)
         data = band.ReadAsArray(x, y, width, height)
         dst_ds.GetRasterBand(bandIdx).WriteArray(data)
 
+    return SetSliceGeoreference(ds, dst_ds, x, y, width, height)
+
+def SetSliceGeoreference(ds, dst_ds, x, y, width, height):
+    gt = ds.GetGeoTransform()
+    cols = ds.RasterXSize
+    rows = ds.RasterYSize
+
     coords = GetCoordinatesFromPixelBox(gt, cols, rows, x, y, width, height)
 
     # top left x, w-e pixel resolution, rotation, top left y, rotation, n-s pixel resolution
@@ -129,138 +232,217 @@ def WriteChunkedGTiff(ds, dst_ds, x, y, width, height):
 def GetExtent(gt, cols, rows):
     ext=[]
 
-    gt = amap(Decimal, gt)
-
-    xarr = amap(Decimal, [0, cols])
-    yarr = amap(Decimal, [0, rows])
+    xarr = [0, cols]
+    yarr = [0, rows]
 
     for px in xarr:
         for py in yarr:
-            x = gt[0] + (px * gt[1]) + (py * gt[2])
-            y = gt[3] + (px * gt[4]) + (py * gt[5])
-
-            ext.append([x, y])
+            x, y = georef.PixelToMap(gt, px, py)
+            ext.append([float(x), float(y)])
 
         yarr.reverse()
 
     return ext
 
 def GetCoordinatesFromPixelBox(gt, cols, rows, x, y, width, height):
-    ext = GetExtent(gt, cols, rows)
+    coords = georef.PixelBoxesToCoords(gt, [x, y, width, height])[0]
 
-    cols, rows, x, y = amap(Decimal, [cols, rows, x, y])
+    return [float(c) for c in coords]
 
-    xOrigin = Decimal(gt[0])
-    yOrigin = Decimal(gt[3])
 
-    bottomLeft, topLeft, topRight, bottomRight = ext
-    xlen = Decimal(topRight[0]) - Decimal(topLeft[0])
-    ylen = Decimal(bottomRight[1]) - Decimal(topRight[1])
+Box = namedtuple("Box", ["xmin", "ymin", "xmax", "ymax", "score"])
+def getPixelBoxesFromShapes(ds, shapes, score = None):
+    boxes = georef.ShapesToPixelBoxes(ds.GetGeoTransform(), shapes)
 
-    # Notice the negative leap with regards to Y.
     return [
-        xOrigin + (x / cols) * xlen,
-        yOrigin - (y / rows) * ylen,
-        xOrigin + ((x + width) / cols) * xlen,
-        yOrigin - ((y + height) / rows) * ylen,
+        Box(
+            xmin = int(xmin),
+            ymin = int(ymin),
+            xmax = int(xmax),
+            ymax = int(ymax),
+            score = score
+        )
+        for xmin, ymin, xmax, ymax in boxes
     ]
 
+def amap(f, l):
+    return list(map(f, l))
 
-Box = namedtuple("Box", ["xmin", "ymin", "xmax", "ymax", "score"])
-def getPixelBoxesFromShapes(ds, shapes, score = None):
-    cols = ds.RasterXSize
-    rows = ds.RasterYSize
+def LoopSlices(
+    ds, sliceSize, overlap, callback,
+    startX = 0, startY = 0, maxX = None, maxY = None,
+    reader = "dataset", tiles = False,
+    workers = 0, ordered = True, queueSize = None,
+    minValid = 0.0, grid = None
+):
+    stats = {
+        "sliced": 0,
+        "skipped": 0
+    }
+
+    if grid is None:
+        grid = tilegrid.FromDataset(ds, sliceSize, overlap).crop(startX, startY, maxX, maxY)
+
+    if workers > 0:
+        import parallel
+
+        source = parallel.ParallelTiles(
+            ds, grid,
+            workers = workers, queueSize = queueSize, ordered = ordered,
+            minValid = minValid, stats = stats
+        )
+    elif tiles == True:
+        source = IterTiles(
+            ds, grid,
+            reader = reader, minValid = minValid, stats = stats
+        )
+    else:
+        source = None
 
-    gt = ds.GetGeoTransform()
+    if source is not None:
+        for tile in source:
+            m = tile if tiles == True else ArrayToDataset(ds, tile.data, tile.x, tile.y)
+            stats["sliced"] = stats["sliced"] + 1
+            callback(m, tile.x, tile.y, tile.width, tile.height)
 
-    ext = GetExtent(gt, cols, rows)
+        return stats
 
-    xOrigin = Decimal(gt[0])
-    yOrigin = Decimal(gt[3])
+    rows = PlanWindows(ds, grid, minValid, stats)
 
-    bottomLeft, topLeft, topRight, bottomRight = ext
-    xlen = Decimal(topRight[0]) - Decimal(topLeft[0])
-    ylen = Decimal(bottomRight[1]) - Decimal(topRight[1])
+    strips = None
+    if reader == "strip":
+        strips = StripReader(ds, *WindowsColumnRange(rows))
+    elif reader != "dataset":
+        raise Exception("Unknown slice reader: {0}".format(reader))
 
-    parsed = []
-    for shape in shapes:
-        xmin = False
-        ymin = False
-        xmax = False
-        ymax = False
+    for row in rows:
+        for xs, ys, w, h in row:
+            if strips is None:
+                m = SliceDataset(ds, xs, ys, w, h)
+            else:
+                m = ArrayToDataset(ds, strips.read(xs, ys, w, h), xs, ys)
 
-        for coords in shape:
-            lon, lat = amap(Decimal, coords)
+            stats["sliced"] = stats["sliced"] + 1
+            callback(m, xs, ys, w, h)
 
-            x = (lon - xOrigin) / xlen * cols
-            y = (yOrigin - lat) / ylen * rows
+    return stats
 
-            xmin = x if not xmin or x < xmin else xmin
-            ymin = y if not ymin or y < ymin else ymin
+def IterTiles(ds, grid, reader = "strip", minValid = 0.0, stats = None):
+    rows = PlanWindows(ds, grid, minValid, stats)
 
-            xmax = x if not xmax or x > xmax else xmax
-            ymax = y if not ymin or y > ymax else ymax
+    if reader == "strip":
+        read = StripReader(ds, *WindowsColumnRange(rows)).read
+    elif reader == "dataset":
+        read = ds.ReadAsArray
+    else:
+        raise Exception("Unknown slice reader: {0}".format(reader))
 
-        parsed.append(Box(
-            xmin = int(xmin),
-            ymin = int(ymin),
-            xmax = int(xmax),
-            ymax = int(ymax),
-            score = score
+    gt = ds.GetGeoTransform()
+    wkt = ds.GetProjection()
+
+    # With the strip reader tile data is a view into the strip buffer and
+    # is only valid until the next tile is requested.
+    for row in rows:
+        for xs, ys, w, h in row:
+            data = read(xs, ys, w, h)
+            if data.ndim == 2:
+                data = data[numpy.newaxis]
+
+            yield Tile(
+                data, xs, ys, TileGeoTransform(gt, xs, ys), wkt,
+                grid.tileIdAt(xs, ys)
+            )
+
+def PlanWindows(ds, grid, minValid = 0.0, stats = None):
+    if not grid.matches(ds):
+        raise Exception("Tile plan {0} does not match the raster size {1}x{2}.".format(
+            grid.key, ds.RasterXSize, ds.RasterYSize
         ))
 
-    return parsed
+    return occupancy.FilterWindows(ds, grid.sliceSize, grid.windowRows(), minValid, stats)
 
-def amap(f, l):
-    return list(map(f, l))
+def WindowsColumnRange(rows):
+    windows = [window for row in rows for window in row]
+    if len(windows) == 0:
+        return 0, 0
 
-def LoopSlices(
-    ds, sliceSize, overlap, callback,
-    startX = 0, startY = 0, maxX = None, maxY = None
-):
-    rasterX = ds.RasterXSize
-    rasterY = ds.RasterYSize
-
-    yCeil = int(math.ceil(rasterY / sliceSize))
-    xCeil = int(math.ceil(rasterX / sliceSize))
-
-    yAmount = 0
-    xAmount = 0
-
-    for y in range(startY, yCeil):
-        if maxY != None and maxY <= yAmount:
-            break
-
-        ys = zeroNegatives(y * sliceSize - overlap)
-        my = 1 if y == 0 else 2
-
-        yAmount = yAmount + 1
-        xAmount = 0
-
-        for x in range(startX, xCeil):
-            if maxX != None and maxX <= xAmount:
-                break
-
-            xs = zeroNegatives(x * sliceSize - overlap)
-
-            mx = 1 if x == 0 else 2
-            
-            w = limit(rasterX, xs, sliceSize + mx * overlap)
-            h = limit(rasterY, ys, sliceSize + my * overlap)
-            
-            m = SliceDataset(
-                ds,
-                xs,
-                ys,
-                w,
-                h
-            )
+    xOff = min([xs for xs, ys, w, h in windows])
+    xEnd = max([xs + w for xs, ys, w, h in windows])
 
-            xAmount = xAmount + 1
-            callback(m, xs, ys, w, h)
+    return xOff, xEnd - xOff
+
+class StripReader:
+    """
+    Reads a raster top to bottom in row strips aligned to the file's block
+    height, keeping the rows still needed by the next row of tiles in a
+    reusable buffer, so each source block is decoded once per run as long
+    as windows are requested in row order.
+    """
+
+    def __init__(self, ds, xOff = 0, xSize = None):
+        self.ds = ds
+        self.blockHeight = ds.GetRasterBand(1).GetBlockSize()[1]
+
+        self.xOff  = xOff
+        self.xSize = ds.RasterXSize - xOff if xSize == None else xSize
+
+        self.buffer = None
+        self.start  = 0
+        self.end    = 0
+
+        self.rowsRead = 0
+
+    def read(self, x, y, width, height):
+        self.ensure(y, y + height)
+
+        top  = y - self.start
+        left = x - self.xOff
+        return self.buffer[:, top:top + height, left:left + width]
+
+    def ensure(self, top, bottom):
+        if top < self.start:
+            raise Exception("Strip reader can only move down the raster.")
+
+        if top >= self.end:
+            # Nothing buffered is reusable, restart on a block boundary.
+            self.start = top - top % self.blockHeight
+            self.end   = self.start
+        elif top > self.start:
+            kept = self.end - top
+            self.buffer[:, :kept] = self.buffer[:, top - self.start:self.end - self.start]
+            self.start = top
+
+        if bottom <= self.end:
+            return
+
+        end = bottom + (-bottom % self.blockHeight)
+        end = min(end, self.ds.RasterYSize)
+
+        self.reserve(end - self.start)
+
+        rows = end - self.end
+        view = self.buffer[:, self.end - self.start:end - self.start]
+        self.ds.ReadAsArray(self.xOff, self.end, self.xSize, rows, buf_obj = view)
+
+        self.end = end
+        self.rowsRead = self.rowsRead + rows
+
+    def reserve(self, rows):
+        if self.buffer is not None and self.buffer.shape[1] >= rows:
+            return
+
+        band = self.ds.GetRasterBand(1)
+        dtype = gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType)
+
+        # Leave room for one extra block row so the buffer is not regrown
+        # on every strip.
+        buffer = numpy.empty(
+            (self.ds.RasterCount, rows + self.blockHeight, self.xSize),
+            dtype = dtype
+        )
 
-def limit(upper, at, value):
-    return upper - at if at + value > upper else value
+        if self.buffer is not None:
+            kept = self.end - self.start
+            buffer[:, :kept] = self.buffer[:, :kept]
 
-def zeroNegatives(v):
-    return 0 if v < 0 else v
+        self.buffer = buffer
@@ -0,0 +1,39 @@
+import sys, getopt
+
+from inference import InferenceServer
+
+def main(argv):
+    model = None
+    path = "/tmp/geotiff-inference.sock"
+
+    try:
+        opts, args = getopt.getopt(argv, "m:s:", ["model=", "socket="])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-m", "--model"):
+            model = arg
+        elif opt in ("-s", "--socket"):
+            path = arg
+
+    if model == None:
+        printUsage()
+        sys.exit(2)
+
+    server = InferenceServer(path, model)
+    print("Serving {0} on {1}".format(model, path))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def printUsage():
+    print("inference-server.py --model <model dir/> [--socket /tmp/geotiff-inference.sock]")
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,194 @@
+import json
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+import numpy as np
+
+# Every message is a frame: a one byte kind and the payload length, then
+# the payload. A detect payload is the image count followed by each image
+# as its height, width and channel count and the raw uint8 pixels. Replies
+# are JSON.
+FRAME  = struct.Struct("!cI")
+COUNT  = struct.Struct("!H")
+IMAGE  = struct.Struct("!HHB")
+
+DETECT  = b"D"
+INFO    = b"I"
+RESULT  = b"R"
+ERROR   = b"E"
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Keeps a model loaded and answers detect requests over a Unix domain
+    socket, so short runs skip importing TensorFlow and loading weights.
+    Connections are served on their own threads, inference runs one batch
+    at a time.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, modelPath):
+        from model import loadWeights, batchDetection
+
+        self.path = path
+        self.modelPath = modelPath
+        self.config, self.weights = loadWeights(modelPath)
+        self.batchDetection = batchDetection
+        self.lock = threading.Lock()
+
+        self.batches = 0
+        self.images  = 0
+
+        # Warm up, the first call builds the prediction function.
+        self.detect([np.zeros((32, 32, 3), dtype = np.uint8)])
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def detect(self, images):
+        with self.lock:
+            annotations = self.batchDetection(self.config, self.weights, images)
+
+            self.batches = self.batches + 1
+            self.images  = self.images + len(images)
+
+        return [
+            [dict(annotation, score = float(annotation["score"])) for annotation in image]
+            for image in annotations
+        ]
+
+    def info(self):
+        return {
+            "model": self.modelPath,
+            "labels": self.config["model"]["labels"],
+            "batches": self.batches,
+            "images": self.images,
+        }
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                kind, payload = receiveFrame(self.request)
+            except EOFError:
+                return
+
+            try:
+                if kind == DETECT:
+                    reply = self.server.detect(unpackImages(payload))
+                elif kind == INFO:
+                    reply = self.server.info()
+                else:
+                    raise Exception("Unknown request {0}".format(kind))
+            except Exception as err:
+                sendFrame(self.request, ERROR, [str(err).encode("utf-8")])
+                continue
+
+            sendFrame(self.request, RESULT, [json.dumps(reply).encode("utf-8")])
+
+class InferenceClient:
+    """
+    Connects to an InferenceServer, detect() takes the same BGR uint8 images
+    as model.batchDetection and returns the same annotations. Safe to share
+    between threads, requests on the connection take turns.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def detect(self, images):
+        if len(images) == 0:
+            return []
+
+        return self.request(DETECT, packImages(images))
+
+    def info(self):
+        return self.request(INFO, [])
+
+    def request(self, kind, parts):
+        # A response belongs to the request sent just before it.
+        with self.lock:
+            sendFrame(self.sock, kind, parts)
+            kind, payload = receiveFrame(self.sock)
+
+        if kind == ERROR:
+            raise Exception("Inference server failed: {0}".format(bytes(payload).decode("utf-8")))
+
+        return json.loads(bytes(payload).decode("utf-8"))
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def packImages(images):
+    # Headers and pixel buffers go out as they are, without joining them.
+    parts = [COUNT.pack(len(images))]
+    for image in images:
+        image = np.ascontiguousarray(image, dtype = np.uint8)
+        if image.ndim == 2:
+            image = image[:, :, np.newaxis]
+
+        h, w, c = image.shape
+        parts.append(IMAGE.pack(h, w, c))
+        parts.append(memoryview(image).cast("B"))
+
+    return parts
+
+def unpackImages(payload):
+    count, = COUNT.unpack_from(payload, 0)
+    offset = COUNT.size
+
+    images = []
+    for i in range(count):
+        h, w, c = IMAGE.unpack_from(payload, offset)
+        offset = offset + IMAGE.size
+
+        size = h * w * c
+        images.append(np.frombuffer(payload, np.uint8, size, offset).reshape((h, w, c)))
+        offset = offset + size
+
+    return images
+
+def sendFrame(sock, kind, parts):
+    length = sum(len(part) for part in parts)
+    sock.sendall(FRAME.pack(kind, length))
+
+    for part in parts:
+        sock.sendall(part)
+
+def receiveFrame(sock):
+    kind, length = FRAME.unpack(receiveExactly(sock, FRAME.size))
+
+    return kind, receiveExactly(sock, length)
+
+def receiveExactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+
+    received = 0
+    while received < size:
+        read = sock.recv_into(view[received:], size - received)
+        if read == 0:
+            raise EOFError("Connection closed")
+
+        received = received + read
+
+    return buffer
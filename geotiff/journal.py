@@ -0,0 +1,85 @@
+import json
+import os
+
+class Journal:
+    """
+    Append-only log of finished tiles and their features, one JSON line per
+    tile. Lines are fsync'd every syncEvery tiles, so a crash loses at most
+    that many tiles of work.
+    """
+
+    def __init__(self, path, gridKey, resume = False, syncEvery = 32):
+        self.path      = path
+        self.syncEvery = syncEvery
+        self.pending   = 0
+
+        self.completed = set()
+        self.features  = []
+        self.tiles     = []
+
+        if resume and os.path.exists(path):
+            end = self.replay(gridKey)
+
+            self.file = open(path, "r+b")
+            # Drop a line left half written by a crash.
+            self.file.truncate(end)
+            self.file.seek(end)
+
+            if end == 0:
+                self.write({"grid": gridKey})
+                self.sync()
+        else:
+            self.file = open(path, "wb")
+            self.write({"grid": gridKey})
+            self.sync()
+
+    def replay(self, gridKey):
+        end = 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+
+                if "grid" in entry:
+                    if entry["grid"] != gridKey:
+                        raise Exception("Journal {0} belongs to plan {1}, not {2}.".format(
+                            self.path, entry["grid"], gridKey
+                        ))
+                else:
+                    self.completed.add(entry["tile"])
+                    self.features.extend(entry["features"])
+                    self.tiles.append((entry["tile"], entry["features"]))
+
+                end = end + len(line)
+
+        return end
+
+    def record(self, tileId, features):
+        self.write({"tile": tileId, "features": features})
+
+        self.pending = self.pending + 1
+        if self.pending >= self.syncEvery:
+            self.sync()
+
+    def write(self, entry):
+        self.file.write(json.dumps(entry).encode("utf-8") + b"\n")
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+def RemainingGrid(grid, journal):
+    return grid.subset([
+        cell for cell in grid.cells
+        if grid.tileId(*cell) not in journal.completed
+    ])
@@ -0,0 +1,80 @@
+import json
+import sys, getopt
+
+import dedupe
+
+def main(argv):
+    output = None
+    mode = None
+    iouThresh = 0.5
+
+    try:
+        opts, args = getopt.getopt(argv, "o:", ["output=", "dedupe=", "dedupe-iou="])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-o", "--output"):
+            output = arg
+        elif opt == "--dedupe":
+            mode = arg
+        elif opt == "--dedupe-iou":
+            iouThresh = float(arg)
+
+    if output == None or len(args) == 0:
+        printUsage()
+        sys.exit(2)
+
+    merged = mergeCollections(args)
+
+    # Shards meet at tile seams, detections along them come in twice.
+    if mode != None:
+        merged["features"] = dedupeFeatures(merged["features"], mode, iouThresh)
+
+    with open(output, "w") as fileOutput:
+        fileOutput.write(json.dumps(merged))
+
+    print("Merged {0} features from {1} files into {2}".format(
+        len(merged["features"]), len(args), output
+    ))
+
+def printUsage():
+    print("merge-geojson.py --output <merged.json> [--dedupe nms|wbf] [--dedupe-iou 0.5] <shard-0.json> <shard-1.json> ...")
+
+def mergeCollections(paths):
+    merged = {
+        "type": "FeatureCollection",
+        "features": []
+    }
+
+    for path in paths:
+        with open(path, "r") as file:
+            collection = json.load(file)
+
+        merged["features"].extend(collection["features"])
+
+    return merged
+
+def dedupeFeatures(features, mode, iouThresh):
+    if len(features) == 0:
+        return features
+
+    # Cells as large as the largest box, any box covers at most 2x2 of them.
+    cellSize = max(
+        max(box[2] - box[0], box[3] - box[1])
+        for box in [dedupe.featureBox(feature) for feature in features]
+    )
+
+    suppressor = dedupe.DuplicateSuppressor(cellSize or 1.0, iouThresh, mode)
+    for feature in features:
+        suppressor.add(feature)
+
+    print("Suppressed {0} duplicate detections of {1}".format(
+        suppressor.suppressed, suppressor.added
+    ))
+
+    return suppressor.releaseAll()
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -3,13 +3,20 @@ import argparse
 import json
 import cv2
 
-from utils.utils import get_yolo_boxes, makedirs
+from utils.utils import get_yolo_boxes, decode_yolos, preprocess_input, makedirs, BatchInput
 from utils.bbox import draw_boxes
 from keras.models import load_model
 
 import re
 import numpy as np
 
+net_h, net_w = 416, 416 # a multiple of 32, the smaller the faster
+obj_thresh, nms_thresh = 0.5, 0.45
+nms_method, nms_top_k = "greedy", None # "linear" or "gaussian" for soft-NMS
+
+# float32 network input reused by every batch, grown to the largest batch
+batchBuffer = BatchInput(net_h, net_w)
+
 def loadWeights(mpath):
     #config_path = re.sub("(config.json)?$", "config.json", mpath)
     config_path = mpath + "config.json"
@@ -17,9 +24,6 @@ def loadWeights(mpath):
     with open(config_path) as config_buffer:
         config = json.load(config_buffer)
 
-    net_h, net_w = 416, 416 # a multiple of 32, the smaller the faster
-    obj_thresh, nms_thresh = 0.5, 0.45
-
     os.environ['CUDA_VISIBLE_DEVICES'] = config['train']['gpus']
     infer_model = load_model(mpath + str(config['train']['saved_weights_name']))
 
@@ -27,15 +31,46 @@ def loadWeights(mpath):
 
     return config, infer_model
 
-def imageDetection(config, model, image_path):
-    net_h, net_w = 416, 416 # a multiple of 32, the smaller the faster
-    obj_thresh, nms_thresh = 0.5, 0.45
+def imageDetection(config, model, image):
+    # Either a path to an image file or an already decoded BGR uint8 array.
+    if isinstance(image, str):
+        image = cv2.imread(image)
+
+    return batchDetection(config, model, [image])[0]
+
+def batchDetection(config, model, images):
+    if len(images) == 0:
+        return []
+
+    # predict the bounding boxes of all images in one pass of the network
+    batch_boxes = get_yolo_boxes(model, images, net_h, net_w, config['model']['anchors'], obj_thresh, nms_thresh, nms_method, nms_top_k, batchBuffer)
 
-    image = cv2.imread(image_path)
+    return [toAnnotations(config, boxes) for boxes in batch_boxes]
 
-    # predict the bounding boxes
-    boxes = get_yolo_boxes(model, [image], net_h, net_w, config['model']['anchors'], obj_thresh, nms_thresh)[0]
+# The steps of batchDetection on their own, for running them on separate
+# threads of a pipeline.
+def preprocessImage(image):
+    # Preprocess workers run concurrently, they do not share resize scratch.
+    inputs = preprocess_input(image, net_h, net_w, batchBuffer.slot())
+    batchBuffer.count(image)
 
+    return inputs
+
+def predictBatch(model, inputs):
+    batch_output = model.predict_on_batch(batchBuffer.stack(inputs))
+    batchBuffer.release(inputs)
+
+    return [
+        [batch_output[0][i], batch_output[1][i], batch_output[2][i]]
+        for i in range(len(inputs))
+    ]
+
+def decodeOutputs(config, yolos, image_h, image_w):
+    boxes = decode_yolos(yolos, image_h, image_w, net_h, net_w, config['model']['anchors'], obj_thresh, nms_thresh, nms_method, nms_top_k)
+
+    return toAnnotations(config, boxes)
+
+def toAnnotations(config, boxes):
     # Put all bounding boxes and labels for this image in a json file
     annotations = list()
     for box in boxes:
@@ -49,4 +84,3 @@ def imageDetection(config, model, image_path):
         })
     
     return annotations
-
@@ -6,11 +6,19 @@ from osgeo import gdal, ogr, osr
 import sys, getopt
 
 import geotiff
-from geojson import newCollection, addFeatureFromBoundingBox
+import tilegrid
+import journal
+import dedupe
+import contentfilter
+import responsecache
+import tileencoding
+from geojson import newCollection, addFeaturesFromBoundingBoxes
 
 import time
 import math
-from decimal import Decimal
+import heapq
+import itertools
+import collections
 
 import numpy as np
 import json
@@ -37,6 +45,7 @@ def main(argv):
     ),
     dict(
         command =  "slice",
+        key = "sliceSize",
         input =  True
     ),
     dict(
@@ -48,6 +57,31 @@ def main(argv):
         key = "tempSlice",
         input =  True
     ),
+    dict(
+        command =  "reader",
+        input =  True,
+        example = "strip"
+    ),
+    dict(
+        command =  "workers",
+        input =  True
+    ),
+    dict(
+        command =  "unordered",
+    ),
+    dict(
+        command =  "min-valid",
+        key = "minValid",
+        input =  True,
+        example = "0.05"
+    ),
+    dict(
+        command =  "journal",
+        input =  True
+    ),
+    dict(
+        command =  "resume",
+    ),
     dict(
         command =  "verbose",
     ),
@@ -59,6 +93,117 @@ def main(argv):
     dict(
         command =  "grid",
     ),
+    dict(
+        command =  "shard",
+        input =  True,
+        example = "0/4"
+    ),
+    dict(
+        command =  "plan",
+        input =  True
+    ),
+    dict(
+        command =  "save-plan",
+        key = "savePlan",
+        input =  True
+    ),
+    dict(
+        command =  "dedupe",
+        input =  True,
+        example = "nms"
+    ),
+    dict(
+        command =  "dedupe-iou",
+        key = "dedupeIou",
+        input =  True,
+        example = "0.5"
+    ),
+    dict(
+        command =  "concurrency",
+        input =  True,
+        example = "4"
+    ),
+    dict(
+        command =  "batch",
+        key = "batchSize",
+        input =  True,
+        example = "8"
+    ),
+    dict(
+        command =  "rate",
+        input =  True,
+        example = "5"
+    ),
+    dict(
+        command =  "api-root",
+        key = "apiRoot",
+        input =  True,
+        example = "http://127.0.0.1:8000"
+    ),
+    dict(
+        command =  "encoding",
+        input =  True,
+        example = "jpeg"
+    ),
+    dict(
+        command =  "quality",
+        input =  True,
+        example = "90"
+    ),
+    dict(
+        command =  "subsampling",
+        input =  True,
+        example = "420"
+    ),
+    dict(
+        command =  "retries",
+        input =  True,
+        example = "5"
+    ),
+    dict(
+        command =  "backoff",
+        input =  True,
+        example = "1.0"
+    ),
+    dict(
+        command =  "min-rate",
+        key = "minRate",
+        input =  True,
+        example = "0.2"
+    ),
+    dict(
+        command =  "cache",
+        input =  True,
+        example = "./nanonets-cache.sqlite"
+    ),
+    dict(
+        command =  "cache-size",
+        key = "cacheSize",
+        input =  True,
+        example = "512"
+    ),
+    dict(
+        command =  "price",
+        key = "pricePerCall",
+        input =  True,
+        example = "0.01"
+    ),
+    dict(
+        command =  "filter",
+        input =  True,
+        example = "variance"
+    ),
+    dict(
+        command =  "filter-threshold",
+        key = "filterThreshold",
+        input =  True,
+        example = "12"
+    ),
+    dict(
+        command =  "filter-background",
+        key = "filterBackground",
+        input =  True
+    ),
     dict(
         command =  "info",
     )]
@@ -77,17 +222,70 @@ def main(argv):
         predOpts.y       = y
         predOpts.rows    = rows
         predOpts.columns = columns
+        predOpts.cut     = True
         del opts["cut"]
 
+    for key in ["sliceSize", "overlap"]:
+        if opts.get(key):
+            opts[key] = int(opts[key])
+
+    if opts.get("shard"):
+        opts["shard"] = tilegrid.ParseShard(opts["shard"])
+
+    if opts.get("workers"):
+        opts["workers"] = int(opts["workers"])
+
+    if opts.get("minValid"):
+        opts["minValid"] = float(opts["minValid"])
+
+    if opts.get("dedupeIou"):
+        opts["dedupeIou"] = float(opts["dedupeIou"])
+
+    if opts.get("concurrency"):
+        opts["concurrency"] = int(opts["concurrency"])
+
+    if opts.get("batchSize"):
+        opts["batchSize"] = int(opts["batchSize"])
+
+    if opts.get("rate"):
+        opts["rate"] = float(opts["rate"])
+
+    if opts.get("retries"):
+        opts["retries"] = int(opts["retries"])
+
+    if opts.get("quality"):
+        opts["quality"] = int(opts["quality"])
+
+    for key in ["backoff", "minRate"]:
+        if opts.get(key):
+            opts[key] = float(opts[key])
+
+    if opts.get("filterThreshold"):
+        opts["filterThreshold"] = float(opts["filterThreshold"])
+
+    if opts.get("cacheSize"):
+        opts["cacheSize"] = float(opts["cacheSize"])
+
+    if opts.get("pricePerCall"):
+        opts["pricePerCall"] = float(opts["pricePerCall"])
+
+    if opts.get("unordered"):
+        predOpts.ordered = False
+        del opts["unordered"]
+
     predOpts.__dict__.update(opts)
     runPrediction(predOpts)
 
+def UploadName(tileId, extension = ".png"):
+    # Tile ids hold a slash, upload names are file names.
+    return tileId.replace("/", "_") + extension
+
 def amap(f, l):
     return list(map(f, l))
 
 class PredictionOptions:
     output = "./nanonets-predict-results.json"
-    tempSlice = "./tempslice.jpg"
+    tempSlice = None
     auth = None
     model = None
     tif = None
@@ -100,8 +298,40 @@ class PredictionOptions:
     columns = 1
     grid = False
     info = False
+    cut = False
+    shard = None
+    plan = None
+    savePlan = None
+    journal = None
+    resume = False
+    reader = "strip"
+    workers = 0
+    ordered = True
+    minValid = 0.0
+    dedupe = None
+    dedupeIou = 0.5
+    concurrency = 4
+    batchSize = 1
+    rate = 5.0
+    minRate = 0.2
+    retries = 5
+    backoff = 1.0
+    encoding = "png"
+    quality = None
+    subsampling = None
+    apiRoot = None
+    cache = None
+    cacheSize = 512
+    pricePerCall = 0.0
+    filter = None
+    filterThreshold = 0.0
+    filterBackground = None
 
 def runPrediction(opts):
+    # Upload bandwidth is what limits remote runs, see compare-encodings.py
+    # for what a smaller encoding costs in detections.
+    encoder = tileencoding.FromOptions(opts)
+
     gdal.UseExceptions();
     ds = gdal.Open(opts.tif)
 
@@ -109,11 +339,6 @@ def runPrediction(opts):
         if opts.verbose == True or opts.info == True:
             print(args[0:])
 
-    geojson = {
-        "type": "FeatureCollection",
-        "features": []
-    }
-
     output = opts.output
 
     sliceSize = opts.sliceSize
@@ -137,72 +362,263 @@ def runPrediction(opts):
         opts.columns, opts.rows
     ))
 
+    if opts.plan != None:
+        plan = tilegrid.Load(opts.plan)
+    else:
+        plan = tilegrid.FromDataset(ds, sliceSize, overlap)
+
+        # Sharding without a cut splits the whole raster.
+        if opts.cut or opts.shard == None:
+            plan = plan.crop(x, y, opts.columns, opts.rows)
+
+    if opts.shard != None:
+        plan = plan.shard(*opts.shard)
+
+    printv("Planned slices: {0}".format(len(plan)))
+
     if opts.info == True:
         return
 
-    def writeJSON():
-        with open(output, "w") as fileOutput:
-            fileOutput.write(json.dumps(geojson, cls=DecimalEncoder))
+    if opts.savePlan != None:
+        plan.save(opts.savePlan)
+        print("Saved plan of {0} slices to {1}".format(len(plan), opts.savePlan))
+        return
+
+    journalPath = output + ".journal" if opts.journal == None else opts.journal
+    tileJournal = journal.Journal(journalPath, plan.key, resume = opts.resume)
+    writer, merger = dedupe.OpenWriter(
+        output, ds, plan, tileJournal, opts.dedupe, opts.dedupeIou, opts.ordered
+    )
+    if opts.resume:
+        plan = journal.RemainingGrid(plan, tileJournal)
+
+        print("Resuming with {0} slices done, {1} features".format(
+            len(tileJournal.completed), len(tileJournal.features)
+        ))
+
+    # Tiles seen by an earlier run are answered from disk.
+    cache = None
+    if opts.cache != None:
+        cache = responsecache.ResponseCache(opts.cache, int(opts.cacheSize * 1024 * 1024))
+
+    client = nano.Client(
+        opts.auth, opts.model,
+        workers = opts.concurrency,
+        rate = opts.rate,
+        apiRoot = opts.apiRoot,
+        cache = cache,
+        minRate = opts.minRate
+    )
 
     class Memo:
         sliced = 0
+        batch = []
+        pending = collections.deque()
+        retries = []
+        retried = 0
+        waiting = {}
+        lost = []
+        order = itertools.count()
 
     memo = Memo()
     def callback(m, xs, ys, w, h):
-        memImage, coords = geotiff.DatasetToJPEG(m, opts.tempSlice)
+        # Encoded in memory, runs in the same directory do not share a
+        # temporary slice.
+        image = encoder.encodeTile(m)
+        coords = geotiff.GetCoords(m)
 
         printv("Slicing: {0}x{1} {2}w {3}h, coords: [{4}, {5}]".format(
             xs, ys, w, h, coords[0], coords[1]
         ))
 
-        res = nano.predictImage(opts.auth, opts.model, memImage.getPath())
-        if res["message"] != "Success":
-            printv("Failed to predict:", memImage.getPath())
+        # Only written to look at.
+        if opts.tempSlice != None:
+            with open(opts.tempSlice, "wb") as file:
+                file.write(image)
+
+        # The tile's pixels are only valid during the callback, keep what
+        # the features need.
+        tile = geotiff.Tile(None, xs, ys, m.GetGeoTransform(), m.GetProjection(), m.id)
+        memo.batch.append((UploadName(m.id, encoder.extension), tile, image, 0))
+
+        if len(memo.batch) >= opts.batchSize:
+            submitBatch()
+
+        submitRetries()
+
+        # Results are handled in tile order, the oldest request is waited
+        # for once enough are in flight.
+        while len(memo.pending) > 0 and (
+            memo.pending[0][1].done() or len(memo.pending) > 2 * opts.concurrency
+        ):
+            addResults(*memo.pending.popleft())
+
+    def submitBatch():
+        batch = memo.batch
+        memo.batch = []
+
+        if len(batch) > 0:
+            future = client.submitBatch([(name, image) for name, tile, image, attempt in batch])
+            memo.pending.append((batch, future))
+
+    def submitRetries():
+        # Failed tiles go again on their own once their backoff is over.
+        while len(memo.retries) > 0 and memo.retries[0][0] <= time.time():
+            item = heapq.heappop(memo.retries)[2]
+            memo.retried = memo.retried + 1
+            memo.pending.append(([item], client.submitBatch([(item[0], item[2])])))
+
+    def retry(item):
+        name, m, image, attempt = item
+
+        if attempt >= opts.retries:
+            printv("Giving up on {0} after {1} attempts".format(m.id, attempt + 1))
+            memo.waiting.pop(m.id, None)
+            memo.lost.append(m.id)
             return
 
-        for result in res["result"]:
-            if result["message"] != "Success":
-                printv("Failed prediction.")
+        delay = nano.BackoffDelay(attempt, opts.backoff)
+        printv("Failed to predict {0}, retrying in {1:.1f}s".format(m.id, delay))
+
+        heapq.heappush(memo.retries, (time.time() + delay, next(memo.order), (name, m, image, attempt + 1)))
+        memo.waiting[m.id] = m.y
+
+    def addResults(batch, future):
+        res = future.result()
+        if res.get("message") != "Success":
+            printv("Failed to predict {0} slices: {1}".format(len(batch), res.get("error", res.get("message"))))
+
+        # Results name the upload they belong to.
+        byInput = {}
+        for result in res.get("result", []) if res.get("message") == "Success" else []:
+            byInput.setdefault(result.get("input"), []).append(result)
+
+        for item in batch:
+            name, m, image, attempt = item
+
+            if res.get("message") != "Success":
+                results = []
+            elif len(batch) == 1:
+                results = res.get("result", [])
+            else:
+                results = byInput.get(name, [])
+
+            if len(results) == 0 or any(result.get("message") != "Success" for result in results):
+                retry(item)
                 continue
 
-            predictions = result["prediction"]
-            for prediction in predictions:
-                addedCoords = addFeatureFromBoundingBox(geojson, m, {
-                    "x": prediction["xmin"],
-                    "y": prediction["ymin"],
-                    "width": prediction["xmax"] - prediction["xmin"],
-                    "height": prediction["ymax"] - prediction["ymin"]
-                },
-                    {
+            memo.waiting.pop(m.id, None)
+            addResult(m, results)
+
+    def addResult(m, results):
+        geojson = newCollection()
+        xs, ys = m.x, m.y
+
+        for result in results:
+            predictions = result.get("prediction", [])
+            addFeaturesFromBoundingBoxes(geojson, m, [
+                [
+                    prediction["xmin"],
+                    prediction["ymin"],
+                    prediction["xmax"] - prediction["xmin"],
+                    prediction["ymax"] - prediction["ymin"]
+                ]
+                for prediction in predictions
+            ], [
+                {
                     "label": prediction["label"],
-                    "score": Decimal(prediction["score"] * 1)
+                    "score": float(prediction["score"])
                 }
-                )
+                for prediction in predictions
+            ])
 
             if len(predictions) > 0:
                 print(len(predictions), "hits at {0}x{1}".format(xs,ys))
-                writeJSON()
 
+        tileJournal.record(m.id, geojson["features"])
+        if merger != None:
+            # Detections above a tile still being retried are not final.
+            merger.add(min([m.y] + list(memo.waiting.values())), geojson["features"])
+        else:
+            writer.add(geojson["features"])
 
         memo.sliced = memo.sliced + 1
         if memo.sliced % 100 == 99:
             print("Sliced another 100, at", xs, ys)
 
-        # Sleep to be lenient with hits on API.
-        time.sleep(0.2)
-
-    geotiff.LoopSlices(
-        ds, sliceSize, overlap, callback,
-        x, y, opts.columns, opts.rows,
+    # Uniform tiles are not worth paying for.
+    tileFilter = contentfilter.FromOptions(opts)
+
+    stats = geotiff.LoopSlices(
+        ds, plan.sliceSize, plan.overlap,
+        contentfilter.Filtered(tileFilter, callback),
+        reader = opts.reader,
+        tiles = True,
+        workers = opts.workers,
+        ordered = opts.ordered,
+        minValid = opts.minValid,
+        grid = plan
     )
 
-    writeJSON()
+    submitBatch()
+    while len(memo.pending) > 0 or len(memo.retries) > 0:
+        submitRetries()
+
+        if len(memo.pending) > 0:
+            addResults(*memo.pending.popleft())
+        else:
+            time.sleep(max(0, memo.retries[0][0] - time.time()))
+
+    client.close()
+
+    # Slices the content filter drops are counted as sliced before it.
+    filtered = 0 if tileFilter == None else tileFilter.skipped
+    print("Predicted {0} slices, skipped {1} empty slices".format(
+        stats["sliced"] - filtered, stats["skipped"]
+    ))
+
+    encoded = encoder.stats()
+    print("Encoded {0} slices as {1}, {2:.1f}kB per slice, {3:.1f}MB in all".format(
+        encoded["tiles"], encoder.name,
+        encoded["bytesPerTile"] / 1024.0, encoded["bytes"] / 1024.0 / 1024.0
+    ))
+
+    if client.breaker != None:
+        print("Retried {0} slices, backed the rate off {1} times, ending at {2:.2f} requests/s".format(
+            memo.retried, client.breaker.trips, client.breaker.rate
+        ))
+    else:
+        print("Retried {0} slices".format(memo.retried))
+
+    # Failed slices stay out of the journal and are redone on resume.
+    if len(memo.lost) > 0:
+        print("{0} slices were never predicted, --resume retries them:".format(len(memo.lost)))
+        for tileId in memo.lost:
+            print("  {0}".format(tileId))
+
+    if tileFilter != None:
+        print("Content filter passed {0} slices, skipped {1}".format(
+            tileFilter.kept, tileFilter.skipped
+        ))
+
+    if cache != None:
+        cacheStats = cache.stats()
+        lookups = cacheStats["hits"] + cacheStats["misses"]
+
+        print("Response cache: {0} hits, {1} misses, {2:.1f}% hit rate, saved {3:.1f}s and {4:.2f} in calls, {5} entries of {6:.1f}MB".format(
+            cacheStats["hits"], cacheStats["misses"],
+            100.0 * cacheStats["hits"] / max(1, lookups),
+            cacheStats["saved"], cacheStats["hits"] * opts.pricePerCall,
+            cacheStats["entries"], cacheStats["bytes"] / 1024.0 / 1024.0
+        ))
+
+        cache.close()
+
+    if merger != None:
+        merger.close()
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, Decimal):
-            return float(o)
-        return super(DecimalEncoder, self).default(o)
+    writer.close()
+    tileJournal.close()
 
 if __name__ == "__main__":
    main(sys.argv[1:])
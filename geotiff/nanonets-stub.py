@@ -0,0 +1,44 @@
+import sys, getopt
+
+import nanonets as nano
+
+def main(argv):
+    port = 8000
+    latency = 0.0
+    failEvery = 0
+    limit = 0
+
+    try:
+        opts, args = getopt.getopt(argv, "p:", ["port=", "latency=", "fail-every=", "limit="])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt in ("-p", "--port"):
+            port = int(arg)
+        elif opt == "--latency":
+            latency = float(arg)
+        elif opt == "--fail-every":
+            failEvery = int(arg)
+        elif opt == "--limit":
+            limit = float(arg)
+
+    server = nano.StubServer(port, latency, failEvery, limit)
+    print("Replaying mockResult on {0}, point nanonets-predict.py --api-root at it".format(server.url))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("Answered {0} requests for {1} files, throttled {2}".format(
+            server.requests, server.files, server.throttled
+        ))
+        server.server_close()
+
+def printUsage():
+    print("nanonets-stub.py [--port 8000] [--latency 0.5] [--fail-every 10] [--limit 5]")
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -1,31 +1,418 @@
 import requests, json
+import copy
+import collections
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
 root = "https://app.nanonets.com/api/v2"
 
-def predictImage(authKey, modelId, imageSrc, mock = False):
-    url = root + "/ObjectDetection/Model/{0}/LabelFile/".format(modelId)
+def predictImage(authKey, modelId, imageSrc, mock = False, session = None, apiRoot = None, cache = None, limiter = None):
+    """
+    Posts one image, a file path or its encoded bytes as bytes or a
+    memoryview, to the model and returns the decoded response. Goes through session when given, a pooled
+    requests.Session keeps its connections alive between calls. A
+    ResponseCache is asked before going to the network, and a RateLimiter
+    only paces the calls that do.
+    """
+    url = (root if apiRoot == None else apiRoot) + "/ObjectDetection/Model/{0}/LabelFile/".format(modelId)
 
     if mock == True:
         return mockResult
 
-    data = {
-        "file": open(imageSrc, "rb")
+    if isinstance(imageSrc, str):
+        with open(imageSrc, "rb") as file:
+            imageSrc = file.read()
+
+    if cache != None:
+        cached = cache.get(imageSrc, modelId)
+        if cached != None:
+            return cached
+
+    if limiter != None:
+        limiter.acquire()
+
+    start = time.time()
+    res = postImage(url, authKey, imageSrc, session)
+
+    if cache != None and succeeded(res):
+        cache.put(imageSrc, modelId, res, time.time() - start)
+
+    return res
+
+def predictImages(authKey, modelId, images, mock = False, session = None, apiRoot = None, cache = None, limiter = None):
+    """
+    Posts several images, (name, encoded bytes or memoryview) pairs, in one
+    multipart request. Each entry of the response's result names its image
+    in input. Images found in cache are left out of the request.
+    """
+    url = (root if apiRoot == None else apiRoot) + "/ObjectDetection/Model/{0}/LabelFile/".format(modelId)
+
+    if mock == True:
+        return MockResults([name for name, image in images])
+
+    if cache == None:
+        if limiter != None:
+            limiter.acquire()
+
+        return postImages(url, authKey, images, session)
+
+    results = {}
+    missing = []
+    for name, image in images:
+        cached = cache.get(image, modelId)
+        if cached != None:
+            results[name] = [dict(result, input = name) for result in cached["result"]]
+        else:
+            missing.append((name, image))
+
+    res = {"message": "Success", "result": []}
+    if len(missing) > 0:
+        if limiter != None:
+            limiter.acquire()
+
+        start = time.time()
+        res = postImages(url, authKey, missing, session)
+        seconds = (time.time() - start) / len(missing)
+
+        if res.get("message") == "Success":
+            byInput = {}
+            for result in res.get("result", []):
+                byInput.setdefault(result.get("input"), []).append(result)
+
+            for name, image in missing:
+                fresh = byInput.get(name, [])
+                results[name] = fresh
+
+                single = {"message": "Success", "result": fresh}
+                if succeeded(single):
+                    cache.put(image, modelId, single, seconds)
+
+    # A failed request still returns what came from the cache.
+    return {
+        "message": "Success" if len(results) > 0 else res.get("message", "Failure"),
+        "result": [
+            result
+            for name, image in images
+            for result in results.get(name, [])
+        ],
     }
 
+def succeeded(res):
+    return res.get("message") == "Success" and len(res.get("result", [])) > 0 and all(
+        result.get("message") == "Success" for result in res["result"]
+    )
+
+def postImage(url, authKey, image, session = None):
+    return postImages(url, authKey, [("tile.jpg", image)], session)
+
+def postImages(url, authKey, images, session = None):
+    data = [
+        ("file", (name, image))
+        for name, image in images
+    ]
+
     headers = {
         "accept": "multipart/form-data",
         "accept-encoding": "deflate",
     }
 
-    r = requests.post(
+    r = (requests if session == None else session).post(
         url,
         files   = data,
         headers = headers,
         auth    = HTTPBasicAuth(authKey, '')
     )
 
-    return json.loads(r.content)
+    failure = {"message": "Failure", "error": "HTTP {0}: {1}".format(r.status_code, " ".join(r.text.split())[:200])}
+
+    # Throttling and server errors often come as HTML pages.
+    if not r.ok:
+        return failure
+
+    try:
+        res = json.loads(r.content)
+    except ValueError:
+        return failure
+
+    # Error payloads, the API's or a proxy's, do not always have a message.
+    if not isinstance(res, dict) or "message" not in res:
+        return failure
+
+    return res
+
+class Client:
+    """
+    Predicts images with up to workers requests in flight over one pooled,
+    keep-alive session. Requests are started no faster than rate per second,
+    with bursts of up to burst requests. Responses held by cache, a
+    ResponseCache, skip the network and the rate limit.
+
+    Requests that raise come back as a Failure response instead. A
+    CircuitBreaker lowers the rate while requests keep failing and raises it
+    again, up to rate, as they succeed.
+    """
+
+    def __init__(self, authKey, modelId, workers = 4, rate = 5.0, burst = 1, apiRoot = None, mock = False, cache = None, minRate = 0.2):
+        self.authKey = authKey
+        self.modelId = modelId
+        self.apiRoot = apiRoot
+        self.mock    = mock
+        self.cache   = cache
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = 1, pool_maxsize = workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.limiter  = RateLimiter(rate, burst)
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+
+        # An unlimited rate has nothing to back off from.
+        self.breaker = None
+        if rate:
+            self.breaker = CircuitBreaker(self.limiter, rate, min(minRate, rate))
+
+    def predict(self, image):
+        return self.guarded(predictImage, image)
+
+    def predictBatch(self, images):
+        return self.guarded(predictImages, images)
+
+    def guarded(self, predict, images):
+        try:
+            res = predict(
+                self.authKey, self.modelId, images,
+                mock = self.mock, session = self.session, apiRoot = self.apiRoot,
+                cache = self.cache, limiter = self.limiter
+            )
+        except (requests.RequestException, ValueError) as err:
+            # Dropped connections and timeouts, error answers are already
+            # turned into a Failure by postImages.
+            res = {"message": "Failure", "error": str(err)}
+
+        if self.breaker != None:
+            self.breaker.record(res.get("message") == "Success")
+
+        return res
+
+    def submit(self, image):
+        """
+        Starts predicting image on a worker thread, returns its Future.
+        """
+        return self.executor.submit(self.predict, image)
+
+    def submitBatch(self, images):
+        """
+        Starts predicting (name, bytes) images in one request, returns its
+        Future.
+        """
+        return self.executor.submit(self.predictBatch, images)
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class RateLimiter:
+    """
+    A token bucket refilled at rate tokens per second, holding at most burst
+    of them. acquire() takes a token, waiting for one if the bucket is empty.
+    A rate of None or 0 does not limit.
+    """
+
+    def __init__(self, rate, burst = 1):
+        self.rate   = rate
+        self.burst  = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last   = time.monotonic()
+        self.lock   = threading.Lock()
+
+    def take(self):
+        """
+        Takes a token if there is one, without waiting.
+        """
+        with self.lock:
+            self.refill()
+
+            if self.tokens >= 1:
+                self.tokens = self.tokens - 1
+                return True
+
+            return False
+
+    def acquire(self):
+        if not self.rate:
+            return
+
+        while True:
+            with self.lock:
+                self.refill()
+
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+    def setRate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+
+    def refill(self):
+        # Caller holds the lock.
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+class CircuitBreaker:
+    """
+    Adapts a RateLimiter to what the API sustains. When more than errorRate
+    of the last window requests failed, the rate is multiplied by decrease,
+    down to minRate. Every success adds increase to it, up to maxRate.
+    """
+
+    def __init__(self, limiter, maxRate, minRate = 0.2, window = 20, errorRate = 0.25, decrease = 0.5, increase = 0.05):
+        self.limiter   = limiter
+        self.maxRate   = maxRate
+        self.minRate   = minRate
+        self.window    = window
+        self.errorRate = errorRate
+        self.decrease  = decrease
+        self.increase  = increase
+        self.lock      = threading.Lock()
+
+        self.outcomes = collections.deque(maxlen = window)
+        self.trips    = 0
+
+    @property
+    def rate(self):
+        return self.limiter.rate
+
+    def record(self, success):
+        with self.lock:
+            self.outcomes.append(success)
+
+            rate = self.limiter.rate
+            if success:
+                rate = min(self.maxRate, rate + self.increase)
+            else:
+                failed = self.outcomes.count(False)
+                if len(self.outcomes) >= self.window // 2 and failed > self.errorRate * len(self.outcomes):
+                    rate = max(self.minRate, rate * self.decrease)
+                    self.trips = self.trips + 1
+
+                    # Judge the new rate on its own requests.
+                    self.outcomes.clear()
+
+            if rate != self.limiter.rate:
+                self.limiter.setRate(rate)
+
+def BackoffDelay(attempt, base = 1.0, cap = 60.0):
+    """
+    Seconds to wait before retry number attempt, counting from 0: uniform
+    between 0 and base * 2 ** attempt, at most cap, so retries of tiles that
+    failed together spread out.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+class StubServer(ThreadingHTTPServer):
+    """
+    A local stand-in for the API that answers every upload with mockResult
+    after latency seconds, for exercising the client without an account.
+    A request of several files gets the mock result once per file. With
+    failEvery every failEvery-th file fails. With limit requests beyond
+    limit per second are throttled with a 429. Serves on 127.0.0.1, port 0
+    picks a free one, see url.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, port = 0, latency = 0.0, failEvery = 0, limit = 0):
+        self.latency   = latency
+        self.failEvery = failEvery
+        self.files     = 0
+        self.requests  = 0
+        self.throttled = 0
+        self.lock      = threading.Lock()
+
+        self.limiter = None
+        if limit:
+            self.limiter = RateLimiter(limit, max(1, int(limit)))
+
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), StubHandler)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.server_address[1])
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if self.server.limiter != None and not self.server.limiter.take():
+            with self.server.lock:
+                self.server.throttled = self.server.throttled + 1
+
+            self.send_error(429, "Too Many Requests")
+            return
+
+        names = [
+            name.decode("utf-8")
+            for name in re.findall(rb'filename="([^"]*)"', body)
+        ]
+
+        with self.server.lock:
+            self.server.requests = self.server.requests + 1
+
+            failed = []
+            for name in names:
+                self.server.files = self.server.files + 1
+                if self.server.failEvery and self.server.files % self.server.failEvery == 0:
+                    failed.append(name)
+
+        time.sleep(self.server.latency)
+
+        body = json.dumps(MockResults(names, failed)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def MockResults(names, failed = []):
+    """
+    mockResult with its result repeated for each of names, failing the ones
+    in failed.
+    """
+    response = copy.deepcopy(mockResult)
+    template = response["result"][0]
+
+    response["result"] = []
+    for name in names:
+        result = dict(template, input = name)
+        if name in failed:
+            result = dict(result, message = "Failure", prediction = [])
+
+        response["result"].append(result)
+
+    return response
 
 mockResult = json.loads("""{
     "message": "Success",
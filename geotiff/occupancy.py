@@ -0,0 +1,97 @@
+import math
+
+import numpy
+from osgeo import gdal
+
+class TileOccupancy:
+    """
+    Fraction of valid pixels in any window of a raster, from a low
+    resolution copy of its mask band. GDAL's mask band covers an alpha band,
+    a nodata value or an explicit mask, and is read from its overviews when
+    the file has them.
+    """
+
+    def __init__(self, ds, sliceSize, samples = 16):
+        band = ds.GetRasterBand(1)
+        flags = band.GetMaskFlags()
+
+        self.rasterX = ds.RasterXSize
+        self.rasterY = ds.RasterYSize
+
+        if flags & gdal.GMF_ALPHA:
+            self.source = "alpha"
+        elif flags & gdal.GMF_NODATA:
+            self.source = "nodata"
+        elif flags & gdal.GMF_ALL_VALID:
+            self.source = "none"
+        else:
+            self.source = "mask"
+
+        self.integral = None
+        if self.source == "none":
+            return
+
+        # Roughly `samples` mask pixels along each side of a slice.
+        scale = max(1, sliceSize // samples)
+        bufX = int(math.ceil(self.rasterX / scale))
+        bufY = int(math.ceil(self.rasterY / scale))
+
+        mask = band.GetMaskBand().ReadAsArray(
+            0, 0, self.rasterX, self.rasterY,
+            buf_xsize = bufX, buf_ysize = bufY
+        )
+
+        self.scaleX = self.rasterX / bufX
+        self.scaleY = self.rasterY / bufY
+
+        integral = numpy.zeros((bufY + 1, bufX + 1), dtype = numpy.int32)
+        numpy.cumsum(mask > 0, axis = 0, out = integral[1:, 1:])
+        numpy.cumsum(integral[1:, 1:], axis = 1, out = integral[1:, 1:])
+
+        self.integral = integral
+
+    def fraction(self, x, y, width, height):
+        if self.integral is None:
+            return 1.0
+
+        x0 = int(x / self.scaleX)
+        y0 = int(y / self.scaleY)
+        x1 = max(int(math.ceil((x + width) / self.scaleX)), x0 + 1)
+        y1 = max(int(math.ceil((y + height) / self.scaleY)), y0 + 1)
+
+        x1 = min(x1, self.integral.shape[1] - 1)
+        y1 = min(y1, self.integral.shape[0] - 1)
+
+        i = self.integral
+        valid = int(i[y1, x1]) - int(i[y0, x1]) - int(i[y1, x0]) + int(i[y0, x0])
+
+        return valid / float((x1 - x0) * (y1 - y0))
+
+def FilterWindows(ds, sliceSize, rows, minValid, stats = None):
+    """
+    Drops the windows whose valid pixel fraction is below minValid, counting
+    them in stats["skipped"] when a stats dict is given.
+    """
+    rows = list(rows)
+    if minValid <= 0:
+        return rows
+
+    occupancy = TileOccupancy(ds, sliceSize)
+
+    filtered = []
+    skipped = 0
+    for row in rows:
+        kept = []
+        for window in row:
+            if occupancy.fraction(*window) < minValid:
+                skipped = skipped + 1
+            else:
+                kept.append(window)
+
+        if len(kept) > 0:
+            filtered.append(kept)
+
+    if stats is not None:
+        stats["skipped"] = stats.get("skipped", 0) + skipped
+
+    return filtered
@@ -0,0 +1,224 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import queue
+import traceback
+
+import numpy
+from osgeo import gdal, gdal_array
+
+import geotiff
+
+def ParallelTiles(
+    ds, grid,
+    workers = 2, queueSize = None, ordered = True, tilesPerTask = 16,
+    minValid = 0.0, stats = None
+):
+    """
+    Reads tiles with a pool of worker processes, each with its own handle on
+    the raster. A task is a run of up to tilesPerTask tiles of one row of the
+    grid, read as a single window into a shared memory slot. At most
+    queueSize slots are in flight, a worker waits for a free slot before
+    taking the next task.
+
+    Tiles are views into the slot and are only valid until the generator is
+    resumed, copy tile.data to keep it. Tasks are delivered in grid order
+    unless ordered is False, in which case they come as soon as they are read.
+    """
+    rows = geotiff.PlanWindows(ds, grid, minValid, stats)
+    tasks = SplitTasks(rows, tilesPerTask)
+    if len(tasks) == 0:
+        return
+
+    queueSize = 2 * workers if queueSize == None else max(queueSize, 1)
+
+    band = ds.GetRasterBand(1)
+    dtype = numpy.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    bands = ds.RasterCount
+
+    slotShape = (
+        bands,
+        max([TaskRegion(task)[3] for task in tasks]),
+        max([TaskRegion(task)[2] for task in tasks]),
+    )
+    slotBytes = int(numpy.prod(slotShape)) * dtype.itemsize
+
+    gt = ds.GetGeoTransform()
+    wkt = ds.GetProjection()
+
+    slots = []
+    procs = []
+    region = None
+    try:
+        for i in range(queueSize):
+            slots.append(shared_memory.SharedMemory(create = True, size = slotBytes))
+
+        # TensorFlow may be loaded and pipeline threads running, neither
+        # survives a fork, readers start fresh.
+        context = multiprocessing.get_context("spawn")
+
+        freeSlots = context.Queue()
+        taskQueue = context.Queue()
+        results   = context.Queue()
+
+        for i in range(queueSize):
+            freeSlots.put(i)
+
+        for index, task in enumerate(tasks):
+            taskQueue.put((index, task))
+
+        for i in range(workers):
+            taskQueue.put(None)
+
+        for i in range(workers):
+            proc = context.Process(
+                target = readWorker,
+                args = (
+                    ds.GetDescription(),
+                    [slot.name for slot in slots],
+                    slotShape,
+                    dtype.str,
+                    freeSlots,
+                    taskQueue,
+                    results
+                ),
+                daemon = True
+            )
+            proc.start()
+            procs.append(proc)
+
+        pending = {}
+        nextIndex = 0
+        delivered = 0
+
+        while delivered < len(tasks):
+            try:
+                message = results.get(timeout = 1)
+            except queue.Empty:
+                # A reader killed by the OOM killer or crashing in GDAL posts
+                # no error of its own.
+                for proc in procs:
+                    if proc.exitcode not in [None, 0]:
+                        raise Exception("Tile reader exited with code {0}".format(proc.exitcode))
+
+                continue
+
+            if message[0] == "error":
+                raise Exception("Tile reader failed:\n" + message[1])
+
+            index, slotIdx = message[1:]
+            pending[index] = slotIdx
+
+            if ordered:
+                ready = []
+                while nextIndex in pending:
+                    ready.append(nextIndex)
+                    nextIndex = nextIndex + 1
+            else:
+                ready = [index]
+
+            for index in ready:
+                slotIdx = pending.pop(index)
+                task = tasks[index]
+                x0, y0, width, height = TaskRegion(task)
+
+                region = numpy.ndarray(
+                    slotShape, dtype = dtype, buffer = slots[slotIdx].buf
+                )[:, :height, :width]
+
+                for xs, ys, w, h in task:
+                    yield geotiff.Tile(
+                        region[:, :, xs - x0:xs - x0 + w],
+                        xs, ys,
+                        geotiff.TileGeoTransform(gt, xs, ys),
+                        wkt,
+                        grid.tileIdAt(xs, ys)
+                    )
+
+                del region
+                delivered = delivered + 1
+                freeSlots.put(slotIdx)
+
+        for i in range(workers):
+            freeSlots.put(None)
+
+        for proc in procs:
+            proc.join(5)
+    finally:
+        region = None
+
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+        for slot in slots:
+            try:
+                slot.close()
+            except BufferError:
+                # A caller still holds a tile view, the mapping goes away
+                # with it.
+                pass
+
+            slot.unlink()
+
+def SplitTasks(rows, tilesPerTask):
+    tasks = []
+    for row in rows:
+        task = []
+        for window in row:
+            # Start a new task at gaps left by skipped tiles, so a task is
+            # always one contiguous window.
+            if len(task) > 0:
+                xs, ys, w, h = task[-1]
+                if len(task) >= tilesPerTask or window[0] > xs + w:
+                    tasks.append(task)
+                    task = []
+
+            task.append(window)
+
+        if len(task) > 0:
+            tasks.append(task)
+
+    return tasks
+
+def TaskRegion(task):
+    x0, y0, w, h = task[0]
+    xs, ys, w, h = task[-1]
+
+    return x0, y0, xs + w - x0, h
+
+def readWorker(path, slotNames, slotShape, dtype, freeSlots, taskQueue, results):
+    try:
+        gdal.UseExceptions()
+        ds = gdal.Open(path)
+
+        slots = [shared_memory.SharedMemory(name = name) for name in slotNames]
+
+        while True:
+            slotIdx = freeSlots.get()
+            if slotIdx is None:
+                break
+
+            task = taskQueue.get()
+            if task is None:
+                break
+
+            index, windows = task
+            x0, y0, width, height = TaskRegion(windows)
+
+            region = numpy.ndarray(
+                slotShape, dtype = dtype, buffer = slots[slotIdx].buf
+            )[:, :height, :width]
+
+            if region.shape[0] == 1:
+                ds.ReadAsArray(x0, y0, width, height, buf_obj = region[0])
+            else:
+                ds.ReadAsArray(x0, y0, width, height, buf_obj = region)
+
+            del region
+
+            results.put(("tile", index, slotIdx))
+
+        for slot in slots:
+            slot.close()
+    except Exception:
+        results.put(("error", traceback.format_exc()))
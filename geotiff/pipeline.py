@@ -0,0 +1,224 @@
+import queue
+import threading
+import time
+
+END     = object()
+DROPPED = object()
+
+class Stage:
+    """
+    One step of a Pipeline. fn maps one item to its result, or with a
+    batchSize a list of items to a list of results. Returning None drops
+    the item. An ordered stage sees its items in the order they were
+    produced and has to run with a single worker.
+    """
+
+    def __init__(self, name, fn, workers = 1, batchSize = None, ordered = False):
+        if ordered and workers != 1:
+            raise Exception("Ordered stage {0} needs a single worker.".format(name))
+
+        self.name      = name
+        self.fn        = fn
+        self.workers   = workers
+        self.batchSize = batchSize
+        self.ordered   = ordered
+
+        self.processed = 0
+        self.busy      = 0.0
+        self.running   = 0
+
+class Pipeline:
+    """
+    Runs items through stages connected by bounded queues, each stage on its
+    own worker threads. Meant for work that releases the GIL, GDAL reads,
+    OpenCV and NumPy, around a single inference stage.
+    """
+
+    def __init__(self, stages, queueSize = 16):
+        self.stages = stages
+        self.queues = [queue.Queue(queueSize) for stage in stages]
+
+        self.lock   = threading.Lock()
+        self.failed = threading.Event()
+        self.error  = None
+        self.seq    = 0
+
+    def run(self, produce):
+        """
+        Calls produce(put) on the calling thread, put feeds one item into the
+        first stage. Returns what produce returned once every item has been
+        through all stages.
+        """
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            stage.running = stage.workers
+            for i in range(stage.workers):
+                thread = threading.Thread(target = self.work, args = (idx,), daemon = True)
+                thread.start()
+                threads.append(thread)
+
+        result = None
+        try:
+            result = produce(self.put)
+        except PipelineFailed:
+            pass
+        except Exception as err:
+            self.fail(err)
+
+        if not self.failed.is_set():
+            for i in range(self.stages[0].workers):
+                self.send(0, END)
+
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+        return result
+
+    def put(self, item):
+        seq = self.seq
+        self.seq = self.seq + 1
+
+        self.send(0, (seq, item))
+
+    def depths(self):
+        return [(stage.name, q.qsize()) for stage, q in zip(self.stages, self.queues)]
+
+    def stats(self):
+        return [
+            {
+                "stage": stage.name,
+                "processed": stage.processed,
+                "busy": stage.busy,
+                "queued": q.qsize(),
+            }
+            for stage, q in zip(self.stages, self.queues)
+        ]
+
+    def send(self, idx, item):
+        while True:
+            if self.failed.is_set() and item is not END:
+                raise PipelineFailed()
+
+            try:
+                self.queues[idx].put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                continue
+
+    def receive(self, idx, block = True):
+        while True:
+            if self.failed.is_set():
+                raise PipelineFailed()
+
+            try:
+                return self.queues[idx].get(block, timeout = 0.1 if block else None)
+            except queue.Empty:
+                if not block:
+                    return None
+
+    def fail(self, err):
+        with self.lock:
+            if self.error is None:
+                self.error = err
+
+        self.failed.set()
+
+    def work(self, idx):
+        stage = self.stages[idx]
+
+        try:
+            if stage.ordered:
+                self.workOrdered(idx)
+            else:
+                self.workUnordered(idx)
+        except PipelineFailed:
+            return
+        except Exception as err:
+            self.fail(err)
+            return
+
+        with self.lock:
+            stage.running = stage.running - 1
+            last = stage.running == 0
+
+        if last and idx + 1 < len(self.stages):
+            for i in range(self.stages[idx + 1].workers):
+                self.send(idx + 1, END)
+
+    def workUnordered(self, idx):
+        stage = self.stages[idx]
+
+        while True:
+            item = self.receive(idx)
+            if item is END:
+                return
+
+            items = [item]
+            ended = False
+
+            # Batch whatever is already queued, never wait for more.
+            while stage.batchSize != None and len(items) < stage.batchSize:
+                item = self.receive(idx, block = False)
+                if item is None:
+                    break
+
+                if item is END:
+                    ended = True
+                    break
+
+                items.append(item)
+
+            self.process(idx, items)
+
+            if ended:
+                return
+
+    def workOrdered(self, idx):
+        pending = {}
+        nextSeq = 0
+
+        while True:
+            item = self.receive(idx)
+            if item is END:
+                break
+
+            pending[item[0]] = item
+
+            while nextSeq in pending:
+                self.process(idx, [pending.pop(nextSeq)])
+                nextSeq = nextSeq + 1
+
+        for seq in sorted(pending.keys()):
+            self.process(idx, [pending.pop(seq)])
+
+    def process(self, idx, items):
+        stage = self.stages[idx]
+
+        values = [value for seq, value in items if value is not DROPPED]
+
+        start = time.time()
+        if len(values) == 0:
+            results = []
+        elif stage.batchSize != None:
+            results = stage.fn(values)
+        else:
+            results = [stage.fn(values[0])]
+
+        with self.lock:
+            stage.busy = stage.busy + time.time() - start
+            stage.processed = stage.processed + len(values)
+
+        results = iter(results)
+        for seq, value in items:
+            if value is not DROPPED:
+                value = next(results)
+                value = DROPPED if value is None else value
+
+            if idx + 1 < len(self.stages):
+                self.send(idx + 1, (seq, value))
+
+class PipelineFailed(Exception):
+    pass
@@ -0,0 +1,248 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy
+
+class ReplicaPool:
+    """
+    The CPU counterpart of utils/multi_gpu_model.py: replicas worker
+    processes each load the model with loadWeights, limited to threads
+    intra-op threads and pinned to their own cores. Batches go to the
+    replicas round-robin.
+
+    detect() is thread safe and blocks until its batch is done, call it
+    from as many threads as there are replicas to keep them all busy.
+    """
+
+    def __init__(self, modelPath, replicas = 2, threads = None, interOpThreads = 1, pin = True):
+        cpus = AvailableCpus()
+        if threads == None:
+            threads = max(1, len(cpus) // replicas)
+
+        self.threads = threads
+        self.lock    = threading.Lock()
+        self.next    = 0
+
+        # TensorFlow does not survive a fork, replicas start fresh.
+        context = multiprocessing.get_context("spawn")
+
+        self.replicas = []
+        try:
+            for i in range(replicas):
+                cores = None
+                if pin:
+                    cores = [cpus[(i * threads + j) % len(cpus)] for j in range(threads)]
+
+                requests = context.Queue()
+                results  = context.Queue()
+
+                proc = context.Process(
+                    target = replicaWorker,
+                    args = (modelPath, threads, interOpThreads, cores, requests, results),
+                    daemon = True
+                )
+                proc.start()
+
+                self.replicas.append(Replica(i, proc, requests, results, cores))
+
+            for replica in self.replicas:
+                replica.receive()
+        except:
+            self.close()
+            raise
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def detect(self, images):
+        if len(images) == 0:
+            return []
+
+        with self.lock:
+            replica = self.replicas[self.next]
+            self.next = (self.next + 1) % len(self.replicas)
+
+        return replica.call(images)
+
+    def stats(self):
+        return [
+            {
+                "replica": replica.index,
+                "cores": replica.cores,
+                "batches": replica.batches,
+                "images": replica.images,
+                "busy": replica.busy,
+            }
+            for replica in self.replicas
+        ]
+
+    def close(self):
+        for replica in self.replicas:
+            replica.stop()
+
+        self.replicas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class Replica:
+    def __init__(self, index, proc, requests, results, cores):
+        self.index    = index
+        self.proc     = proc
+        self.requests = requests
+        self.results  = results
+        self.cores    = cores
+        self.lock     = threading.Lock()
+
+        self.batches = 0
+        self.images  = 0
+        self.busy    = 0.0
+
+    def call(self, images):
+        with self.lock:
+            start = time.time()
+
+            self.requests.put(images)
+            annotations = self.receive()
+
+            self.batches = self.batches + 1
+            self.images  = self.images + len(images)
+            self.busy    = self.busy + time.time() - start
+
+        return annotations
+
+    def receive(self):
+        while True:
+            try:
+                message = self.results.get(timeout = 1)
+            except queue.Empty:
+                if not self.proc.is_alive():
+                    raise Exception("Replica {0} exited with code {1}".format(
+                        self.index, self.proc.exitcode
+                    ))
+
+                continue
+
+            if message[0] == "error":
+                raise Exception("Replica {0} failed:\n{1}".format(self.index, message[1]))
+
+            return message[1]
+
+    def stop(self):
+        if self.proc.is_alive():
+            self.requests.put(None)
+            self.proc.join(5)
+
+        if self.proc.is_alive():
+            self.proc.terminate()
+
+def AvailableCpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count()))
+
+def PinThreads(threads, interOpThreads):
+    """
+    Limits TensorFlow's thread pools, has to run before the model is loaded.
+    """
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+
+    import tensorflow as tf
+
+    if hasattr(tf, "config") and hasattr(tf.config, "threading"):
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+        tf.config.threading.set_inter_op_parallelism_threads(interOpThreads)
+    else:
+        from keras import backend
+
+        backend.set_session(tf.Session(config = tf.ConfigProto(
+            intra_op_parallelism_threads = threads,
+            inter_op_parallelism_threads = interOpThreads
+        )))
+
+def replicaWorker(modelPath, threads, interOpThreads, cores, requests, results):
+    try:
+        if cores != None and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+
+        PinThreads(threads, interOpThreads)
+
+        from model import loadWeights, batchDetection
+
+        config, weights = loadWeights(modelPath)
+
+        # Warm up, the first call builds the prediction function.
+        batchDetection(config, weights, [numpy.zeros((32, 32, 3), dtype = numpy.uint8)])
+        results.put(("ready", None))
+
+        while True:
+            images = requests.get()
+            if images is None:
+                break
+
+            results.put(("result", batchDetection(config, weights, images)))
+    except Exception:
+        results.put(("error", traceback.format_exc()))
+
+def Autotune(modelPath, images, batchSize = 8, combinations = None):
+    """
+    Runs images through pools of every replicas x threads combination that
+    fits the available cores and returns the measurements, best tiles/s
+    first.
+    """
+    cpus = len(AvailableCpus())
+    if combinations == None:
+        combinations = [
+            (replicas, cpus // replicas)
+            for replicas in range(1, cpus + 1)
+            if cpus % replicas == 0
+        ]
+
+    batches = [images[i:i + batchSize] for i in range(0, len(images), batchSize)]
+
+    measured = []
+    for replicas, threads in combinations:
+        errors = []
+        with ReplicaPool(modelPath, replicas, threads) as pool:
+            def work(offset):
+                try:
+                    for batch in batches[offset::replicas]:
+                        pool.detect(batch)
+                except Exception as err:
+                    errors.append(err)
+
+            start = time.time()
+
+            workers = [threading.Thread(target = work, args = (i,)) for i in range(replicas)]
+            for worker in workers:
+                worker.start()
+
+            for worker in workers:
+                worker.join()
+
+            elapsed = time.time() - start
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        measured.append({
+            "replicas": replicas,
+            "threads": threads,
+            "tilesPerSecond": len(images) / elapsed,
+        })
+
+        print("  {0} replicas x {1} threads: {2:.2f} tiles/s".format(
+            replicas, threads, len(images) / elapsed
+        ))
+
+    measured.sort(key = lambda result: -result["tilesPerSecond"])
+
+    return measured
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+class ResponseCache:
+    """
+    Byte budgeted LRU cache of detection responses in a single SQLite file,
+    keyed by the sha256 of the model id and the encoded tile bytes, so the
+    same tile sent to the same model is only paid for once across runs.
+    Entries remember how long the request took, for the report of the time
+    saved. Safe to share between threads.
+    """
+
+    def __init__(self, path, maxBytes = 512 * 1024 * 1024):
+        self.path     = path
+        self.maxBytes = maxBytes
+        self.lock     = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key      TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size     INTEGER NOT NULL,
+                seconds  REAL NOT NULL,
+                used     REAL NOT NULL
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS responsesUsed ON responses (used)")
+        self.db.commit()
+
+        self.bytes = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.saved     = 0.0
+
+    def get(self, image, modelId):
+        key = CacheKey(image, modelId)
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT response, seconds FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses = self.misses + 1
+                return None
+
+            self.db.execute("UPDATE responses SET used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+
+            self.hits  = self.hits + 1
+            self.saved = self.saved + row[1]
+
+        return json.loads(row[0])
+
+    def put(self, image, modelId, response, seconds):
+        key = CacheKey(image, modelId)
+        encoded = json.dumps(response)
+
+        with self.lock:
+            old = self.db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.bytes = self.bytes - old[0]
+
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, seconds, used) VALUES (?, ?, ?, ?, ?)",
+                (key, encoded, len(encoded), seconds, time.time())
+            )
+            self.bytes = self.bytes + len(encoded)
+
+            self.evict()
+            self.db.commit()
+
+    def evict(self):
+        # Drops the least recently used entries, caller holds the lock.
+        while self.bytes > self.maxBytes:
+            rows = self.db.execute(
+                "SELECT key, size FROM responses ORDER BY used LIMIT 64"
+            ).fetchall()
+            if len(rows) == 0:
+                break
+
+            for key, size in rows:
+                if self.bytes <= self.maxBytes:
+                    break
+
+                self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.bytes = self.bytes - size
+                self.evictions = self.evictions + 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "saved": self.saved,
+            }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+def CacheKey(image, modelId):
+    digest = hashlib.sha256()
+    digest.update(str(modelId).encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(image)
+
+    return digest.hexdigest()
@@ -0,0 +1,159 @@
+import threading
+from collections import OrderedDict
+
+from osgeo import gdal
+
+class CachedImage:
+    """
+    An encoded tile living in /vsimem. Handles are reference counted, every
+    handle returned by TileCache must be released once the caller is done
+    with the path. The files are only unlinked after the entry is evicted
+    and the last handle is released.
+    """
+
+    def __init__(self, cache, key, path):
+        self.cache      = cache
+        self.key        = key
+        self.path       = path
+        self.coordsPath = path + ".aux.xml"
+        self.size       = 0
+        self.refs       = 0
+        self.evicted    = False
+        self.unlinked   = False
+
+    def getPath(self):
+        if self.unlinked:
+            raise Exception("Cached image has been released and evicted.")
+
+        return self.path
+
+    def release(self):
+        self.cache.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+class TileCache:
+    """
+    Byte budgeted LRU cache of encoded tiles in GDAL's in-memory filesystem.
+    Safe to share between threads.
+    """
+
+    def __init__(self, maxBytes = 256 * 1024 * 1024, prefix = "/vsimem/tilecache"):
+        self.maxBytes = maxBytes
+        self.prefix   = prefix
+
+        self.entries = OrderedDict()
+        self.lock    = threading.RLock()
+        self.bytes   = 0
+        self.counter = 0
+
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+
+            self.hits = self.hits + 1
+            self.entries.move_to_end(key)
+            entry.refs = entry.refs + 1
+
+            return entry
+
+    def encode(self, tif, options, key = None):
+        if key is not None:
+            entry = self.get(key)
+            if entry is not None:
+                return entry
+
+        with self.lock:
+            self.counter = self.counter + 1
+            path = "{0}/{1}.png".format(self.prefix, self.counter)
+
+            if key is None:
+                key = path
+
+        entry = CachedImage(self, key, path)
+
+        # Encode outside of the lock, other threads keep using the cache.
+        gdal.Translate(path, tif, options = options)
+        entry.size = fileSize(entry.path) + fileSize(entry.coordsPath)
+
+        with self.lock:
+            existing = self.entries.get(key)
+            if existing is not None:
+                # Another thread encoded the same tile meanwhile.
+                unlink(entry)
+                existing.refs = existing.refs + 1
+                self.entries.move_to_end(key)
+                return existing
+
+            entry.refs = 1
+            self.entries[key] = entry
+            self.bytes = self.bytes + entry.size
+
+            self.evict()
+
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            if entry.refs <= 0:
+                raise Exception("Cached image released more often than acquired.")
+
+            entry.refs = entry.refs - 1
+
+            if entry.refs == 0 and entry.evicted:
+                unlink(entry)
+            else:
+                self.evict()
+
+    def evict(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if self.bytes <= self.maxBytes:
+                    break
+
+                entry = self.entries.pop(key)
+                self.bytes = self.bytes - entry.size
+                self.evictions = self.evictions + 1
+
+                entry.evicted = True
+                if entry.refs == 0:
+                    unlink(entry)
+
+    def clear(self):
+        with self.lock:
+            maxBytes = self.maxBytes
+            self.maxBytes = 0
+            self.evict()
+            self.maxBytes = maxBytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+def fileSize(path):
+    stat = gdal.VSIStatL(path)
+    return 0 if stat is None else stat.size
+
+def unlink(entry):
+    for path in [entry.path, entry.coordsPath]:
+        if gdal.VSIStatL(path) is not None:
+            gdal.Unlink(path)
+
+    entry.unlinked = True
@@ -0,0 +1,128 @@
+import threading
+
+FORMATS = ["png", "jpeg", "webp"]
+SUBSAMPLING = ["444", "422", "420"]
+
+EXTENSIONS = {
+    "png": ".png",
+    "jpeg": ".jpg",
+    "webp": ".webp",
+}
+
+class TileEncoder:
+    """
+    Encodes BGR uint8 tiles, as returned by geotiff.TileToImage, for upload
+    to a remote backend:
+
+    png   lossless, what GTifToJPEG writes
+    jpeg  at quality 1-100, with subsampling 444, 422 or 420 chroma
+    webp  at quality 1-100, always 420, above 100 lossless
+
+    Counts the tiles and bytes it encoded, safe to share between threads.
+    """
+
+    def __init__(self, format = "png", quality = None, subsampling = None):
+        if format not in FORMATS:
+            raise Exception("Unknown tile encoding: {0}".format(format))
+
+        if subsampling != None and subsampling not in SUBSAMPLING:
+            raise Exception("Unknown chroma subsampling: {0}".format(subsampling))
+
+        if format == "png" and (quality != None or subsampling != None):
+            raise Exception("PNG is lossless, it takes no quality or subsampling.")
+
+        if format == "webp" and subsampling not in [None, "420"]:
+            raise Exception("Lossy WebP is always 420 subsampled.")
+
+        self.format      = format
+        self.quality     = quality
+        self.subsampling = subsampling
+        self.lock        = threading.Lock()
+
+        self.tiles = 0
+        self.bytes = 0
+
+    @property
+    def extension(self):
+        return EXTENSIONS[self.format]
+
+    @property
+    def name(self):
+        name = self.format
+        if self.quality != None:
+            name = name + ":{0}".format(self.quality)
+        if self.subsampling != None:
+            name = name + ":{0}".format(self.subsampling)
+
+        return name
+
+    def params(self):
+        import cv2
+
+        params = []
+        if self.format == "jpeg":
+            if self.quality != None:
+                params = params + [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+            if self.subsampling != None:
+                params = params + [
+                    cv2.IMWRITE_JPEG_SAMPLING_FACTOR,
+                    getattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR_" + self.subsampling)
+                ]
+        elif self.format == "webp" and self.quality != None:
+            params = params + [cv2.IMWRITE_WEBP_QUALITY, self.quality]
+
+        return params
+
+    def encode(self, image):
+        encoded = EncodeImage(image, self.format, self.params())
+
+        with self.lock:
+            self.tiles = self.tiles + 1
+            self.bytes = self.bytes + len(encoded)
+
+        return encoded
+
+    def encodeTile(self, tile):
+        import geotiff
+
+        return self.encode(geotiff.TileToImage(tile))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "tiles": self.tiles,
+                "bytes": self.bytes,
+                "bytesPerTile": self.bytes / max(1, self.tiles),
+            }
+
+def EncodeImage(image, format = "png", params = None):
+    """
+    The image encoded in memory with OpenCV, as a memoryview on the bytes.
+    """
+    import cv2
+
+    ok, encoded = cv2.imencode(EXTENSIONS[format], image, [] if params == None else params)
+    if not ok:
+        raise Exception("Could not encode image as {0}".format(format))
+
+    return memoryview(encoded.reshape(-1))
+
+def ParseEncoding(spec):
+    """
+    A TileEncoder from format[:quality[:subsampling]], e.g. jpeg:85:420.
+    """
+    parts = spec.split(":")
+    if len(parts) > 3:
+        raise Exception("Encoding {0} is not format[:quality[:subsampling]].".format(spec))
+
+    quality = int(parts[1]) if len(parts) > 1 and parts[1] != "" else None
+    subsampling = parts[2] if len(parts) > 2 else None
+
+    return TileEncoder(parts[0], quality, subsampling)
+
+def FromOptions(opts):
+    """
+    The TileEncoder asked for by the encoding, quality and subsampling
+    options of a predict script.
+    """
+    return TileEncoder(opts.encoding, opts.quality, opts.subsampling)
@@ -0,0 +1,157 @@
+import json
+import math
+
+class TileGrid:
+    """
+    The slicing plan of a raster: the grid of sliceSize tiles, each grown by
+    overlap pixels on every side, and optionally the subset of grid cells to
+    process. Tile ids only depend on the raster size, slice size, overlap
+    and the cell, so they are stable between runs, shards and machines.
+    """
+
+    def __init__(self, rasterX, rasterY, sliceSize, overlap, cells = None):
+        if overlap >= sliceSize:
+            raise Exception("Overlap has to be smaller than the slice size.")
+
+        self.rasterX   = rasterX
+        self.rasterY   = rasterY
+        self.sliceSize = sliceSize
+        self.overlap   = overlap
+
+        self.columns = int(math.ceil(rasterX / sliceSize))
+        self.rows    = int(math.ceil(rasterY / sliceSize))
+
+        if cells is None:
+            cells = [
+                (row, col)
+                for row in range(self.rows)
+                for col in range(self.columns)
+            ]
+
+        self.cells = [tuple(cell) for cell in cells]
+
+    @property
+    def key(self):
+        return "{0}x{1}-s{2}-o{3}".format(
+            self.rasterX, self.rasterY, self.sliceSize, self.overlap
+        )
+
+    def __len__(self):
+        return len(self.cells)
+
+    def tileId(self, row, col):
+        return "{0}/{1}-{2}".format(self.key, row, col)
+
+    def tileIdAt(self, xs, ys):
+        return self.tileId(*self.cellAt(xs, ys))
+
+    def cellOfId(self, tileId):
+        key, cell = tileId.rsplit("/", 1)
+        if key != self.key:
+            raise Exception("Tile {0} is not part of plan {1}.".format(tileId, self.key))
+
+        row, col = cell.split("-")
+
+        return int(row), int(col)
+
+    def cellAt(self, xs, ys):
+        row = 0 if ys == 0 else (ys + self.overlap) // self.sliceSize
+        col = 0 if xs == 0 else (xs + self.overlap) // self.sliceSize
+
+        return row, col
+
+    def window(self, row, col):
+        ys = zeroNegatives(row * self.sliceSize - self.overlap)
+        xs = zeroNegatives(col * self.sliceSize - self.overlap)
+
+        my = 1 if row == 0 else 2
+        mx = 1 if col == 0 else 2
+
+        w = limit(self.rasterX, xs, self.sliceSize + mx * self.overlap)
+        h = limit(self.rasterY, ys, self.sliceSize + my * self.overlap)
+
+        return xs, ys, w, h
+
+    def windowRows(self):
+        """
+        The windows of the planned cells as a list of grid rows, in row
+        major order.
+        """
+        rows = []
+        current = None
+        for row, col in self.cells:
+            if current != row:
+                rows.append([])
+                current = row
+
+            rows[-1].append(self.window(row, col))
+
+        return rows
+
+    def subset(self, cells):
+        return TileGrid(self.rasterX, self.rasterY, self.sliceSize, self.overlap, cells)
+
+    def crop(self, startX = 0, startY = 0, maxX = None, maxY = None):
+        """
+        Keeps maxX columns and maxY rows of cells starting at grid cell
+        startX x startY, the same selection LoopSlices takes.
+        """
+        endX = self.columns if maxX == None else min(self.columns, startX + maxX)
+        endY = self.rows if maxY == None else min(self.rows, startY + maxY)
+
+        return self.subset([
+            (row, col) for row, col in self.cells
+            if startY <= row < endY and startX <= col < endX
+        ])
+
+    def shard(self, index, count):
+        """
+        Shard index of count, an even, contiguous share of the planned cells.
+        """
+        if index < 0 or index >= count:
+            raise Exception("Shard {0} out of range for {1} shards.".format(index, count))
+
+        total = len(self.cells)
+        start = index * total // count
+        end   = (index + 1) * total // count
+
+        return self.subset(self.cells[start:end])
+
+    def save(self, path):
+        with open(path, "w") as file:
+            json.dump({
+                "rasterX": self.rasterX,
+                "rasterY": self.rasterY,
+                "sliceSize": self.sliceSize,
+                "overlap": self.overlap,
+                "cells": self.cells,
+            }, file)
+
+    def matches(self, ds):
+        return self.rasterX == ds.RasterXSize and self.rasterY == ds.RasterYSize
+
+def FromDataset(ds, sliceSize, overlap):
+    return TileGrid(ds.RasterXSize, ds.RasterYSize, sliceSize, overlap)
+
+def Load(path):
+    with open(path, "r") as file:
+        plan = json.load(file)
+
+    return TileGrid(
+        plan["rasterX"],
+        plan["rasterY"],
+        plan["sliceSize"],
+        plan["overlap"],
+        plan["cells"]
+    )
+
+def ParseShard(value):
+    index, count = [int(part) for part in value.split("/")]
+
+    return index, count
+
+def limit(upper, at, value):
+    return upper - at if at + value > upper else value
+
+def zeroNegatives(v):
+    return 0 if v < 0 else v
@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
 import os
+import threading
 from .bbox import BoundBox, bbox_iou
 from scipy.special import expit
 
@@ -146,7 +147,42 @@ def correct_yolo_boxes(boxes, image_h, image_w, net_h, net_w):
         boxes[i].ymin = int((boxes[i].ymin - y_offset) / y_scale * image_h)
         boxes[i].ymax = int((boxes[i].ymax - y_offset) / y_scale * image_h)
         
-def do_nms(boxes, nms_thresh):
+def correct_yolo_boxes_array(boxes, image_h, image_w, net_h, net_w):
+    """ correct_yolo_boxes on an (N, 4) array of xmin, ymin, xmax, ymax,
+    returning the image pixel boxes as an (N, 4) integer array.
+    """
+    if (float(net_w)/image_w) < (float(net_h)/image_h):
+        new_w = net_w
+        new_h = (image_h*net_w)/image_w
+    else:
+        new_h = net_w
+        new_w = (image_w*net_h)/image_h
+
+    x_offset, x_scale = (net_w - new_w)/2./net_w, float(new_w)/net_w
+    y_offset, y_scale = (net_h - new_h)/2./net_h, float(new_h)/net_h
+
+    corrected = np.empty(boxes.shape, dtype = np.int64)
+    corrected[:, 0::2] = (boxes[:, 0::2] - x_offset) / x_scale * image_w
+    corrected[:, 1::2] = (boxes[:, 1::2] - y_offset) / y_scale * image_h
+
+    return corrected
+
+def do_nms(boxes, nms_thresh, method="greedy", top_k=None):
+    if len(boxes) == 0:
+        return
+
+    coords = np.array([[box.xmin, box.ymin, box.xmax, box.ymax] for box in boxes], dtype=np.float64)
+    scores = np.array([box.classes for box in boxes])
+
+    scores = nms_array(coords, scores, nms_thresh, method, top_k)
+
+    for box, classes in zip(boxes, scores):
+        box.classes[:] = classes
+
+def do_nms_pairwise(boxes, nms_thresh):
+    """ The original per class, per pair NMS over BoundBoxes, kept as the
+    reference nms_array is checked against, see benchmark.py --nms.
+    """
     if len(boxes) > 0:
         nb_class = len(boxes[0].classes)
     else:
@@ -166,78 +202,294 @@ def do_nms(boxes, nms_thresh):
                 if bbox_iou(boxes[index_i], boxes[index_j]) >= nms_thresh:
                     boxes[index_j].classes[c] = 0
 
+def nms_array(boxes, scores, nms_thresh, method="greedy", top_k=None, sigma=0.5, score_thresh=0.):
+    """ Class aware non-maximum suppression over arrays.
+
+    # Arguments
+        boxes        : (N, 4) array of xmin, ymin, xmax, ymax.
+        scores       : (N, C) array of class scores, 0 for no detection.
+        nms_thresh   : Boxes overlapping a better one of the same class by at
+                       least this IoU are suppressed, or decayed by soft-NMS.
+        method       : "greedy" zeroes suppressed scores like do_nms_pairwise,
+                       "linear" and "gaussian" are the soft-NMS decays.
+        top_k        : Only the top_k scores of each class take part, the
+                       rest are zeroed up front.
+        sigma        : Spread of the gaussian decay.
+        score_thresh : Soft-NMS zeroes scores decayed below it.
+    # Returns
+        A copy of scores with the suppressed ones zeroed or decayed.
+    """
+    if method not in ["greedy", "linear", "gaussian"]:
+        raise ValueError("Unknown NMS method: {0}".format(method))
+
+    scores = np.array(scores, copy=True)
+
+    for c in range(scores.shape[1]):
+        column = scores[:, c]
+        order  = np.argsort(-column)
+
+        if top_k is not None:
+            column[order[top_k:]] = 0
+            order = order[:top_k]
+
+        order = order[column[order] > 0]
+
+        if method == "greedy":
+            _greedy_nms(boxes[order], column, order, nms_thresh)
+        else:
+            _soft_nms(boxes, column, order, nms_thresh, method, sigma, score_thresh)
+
+    return scores
+
+def _greedy_nms(boxes, column, order, nms_thresh):
+    # boxes are in descending score order, a kept box suppresses every
+    # later one it overlaps
+    alive = np.ones(len(order), dtype=bool)
+
+    for i in range(len(order)):
+        if not alive[i]: continue
+
+        rest = i + 1 + np.flatnonzero(alive[i+1:])
+        alive[rest[_box_iou(boxes[i], boxes[rest]) >= nms_thresh]] = False
+
+    column[order[~alive]] = 0
+
+def _soft_nms(boxes, column, order, nms_thresh, method, sigma, score_thresh):
+    while len(order) > 0:
+        best  = np.argmax(column[order])
+        index = order[best]
+        order = np.delete(order, best)
+
+        overlap = _box_iou(boxes[index], boxes[order])
+        if method == "linear":
+            decay = np.where(overlap >= nms_thresh, 1 - overlap, 1.)
+        else:
+            decay = np.exp(-(overlap * overlap) / sigma)
+
+        column[order] *= decay
+
+        dropped = column[order] < score_thresh
+        column[order[dropped]] = 0
+        order = order[~dropped]
+
+def _box_iou(box, boxes):
+    # the same operations as bbox_iou, one box against many
+    intersect_w = np.maximum(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0)
+    intersect_h = np.maximum(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0)
+
+    intersect = intersect_w * intersect_h
+
+    w1, h1 = box[2]-box[0], box[3]-box[1]
+    w2, h2 = boxes[:, 2]-boxes[:, 0], boxes[:, 3]-boxes[:, 1]
+
+    union = w1*h1 + w2*h2 - intersect
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return intersect / union
+
 def decode_netout(netout, anchors, obj_thresh, net_h, net_w):
+    boxes = []
+
+    for row in decode_netout_array(netout, anchors, obj_thresh, net_h, net_w):
+        boxes.append(BoundBox(row[0], row[1], row[2], row[3], row[4], row[5:]))
+
+    return boxes
+
+def decode_netout_array(netout, anchors, obj_thresh, net_h, net_w):
+    """ Decode one YOLO head without a loop over the grid.
+
+    # Arguments
+        netout     : The (grid_h, grid_w, 3 * (5 + nb_class)) output of a head.
+        anchors    : The 3 anchor width and height pairs of the head.
+        obj_thresh : Cells with objectness at or below it are dropped.
+        net_h      : The height of the network input.
+        net_w      : The width of the network input.
+    # Returns
+        A (N, 5 + nb_class) array of xmin, ymin, xmax, ymax, objectness
+        and the class scores, in grid row, column and anchor order, the
+        same values decode_netout puts into its BoundBoxes.
+    """
     grid_h, grid_w = netout.shape[:2]
     nb_box = 3
     netout = netout.reshape((grid_h, grid_w, nb_box, -1))
-    nb_class = netout.shape[-1] - 5
+    dtype  = netout.dtype
 
-    boxes = []
+    # 4th element is objectness score, only the cells above it are decoded
+    objectness = _sigmoid(netout[..., 4])
+    rows, cols, b = np.nonzero(objectness > obj_thresh)
 
-    netout[..., :2]  = _sigmoid(netout[..., :2])
-    netout[..., 4]   = _sigmoid(netout[..., 4])
-    netout[..., 5:]  = netout[..., 4][..., np.newaxis] * _softmax(netout[..., 5:])
-    netout[..., 5:] *= netout[..., 5:] > obj_thresh
+    cells      = netout[rows, cols, b]
+    objectness = objectness[rows, cols, b]
 
-    for i in range(grid_h*grid_w):
-        row = i // grid_w
-        col = i % grid_w
-        
-        for b in range(nb_box):
-            # 4th element is objectness score
-            objectness = netout[row, col, b, 4]
-            
-            if(objectness <= obj_thresh): continue
-            
-            # first 4 elements are x, y, w, and h
-            x, y, w, h = netout[row,col,b,:4]
-
-            x = (col + x) / grid_w # center position, unit: image width
-            y = (row + y) / grid_h # center position, unit: image height
-            w = anchors[2 * b + 0] * np.exp(w) / net_w # unit: image width
-            h = anchors[2 * b + 1] * np.exp(h) / net_h # unit: image height  
-            
-            # last elements are class probabilities
-            classes = netout[row,col,b,5:]
-            
-            box = BoundBox(x-w/2, y-h/2, x+w/2, y+h/2, objectness, classes)
-
-            boxes.append(box)
+    # first 4 elements are x, y, w, and h
+    xy = _sigmoid(cells[:, :2])
+    anchors = np.asarray(anchors, dtype = dtype).reshape((nb_box, 2))[b]
 
-    return boxes
+    x = (cols.astype(dtype) + xy[:, 0]) / grid_w # center position, unit: image width
+    y = (rows.astype(dtype) + xy[:, 1]) / grid_h # center position, unit: image height
+    w = anchors[:, 0] * np.exp(cells[:, 2]) / net_w # unit: image width
+    h = anchors[:, 1] * np.exp(cells[:, 3]) / net_h # unit: image height
 
-def preprocess_input(image, net_h, net_w):
-    new_h, new_w, _ = image.shape
+    # last elements are class probabilities
+    classes  = objectness[:, np.newaxis] * _softmax(cells[:, 5:])
+    classes *= classes > obj_thresh
 
-    # determine the new size of the image
-    if (float(net_w)/new_w) < (float(net_h)/new_h):
-        new_h = (new_h * net_w)//new_w
-        new_w = net_w
-    else:
-        new_w = (new_w * net_h)//new_h
-        new_h = net_h
+    decoded = np.empty((len(cells), 5 + classes.shape[1]), dtype = dtype)
+    decoded[:, 0] = x - w/2
+    decoded[:, 1] = y - h/2
+    decoded[:, 2] = x + w/2
+    decoded[:, 3] = y + h/2
+    decoded[:, 4] = objectness
+    decoded[:, 5:] = classes
+
+    return decoded
+
+def preprocess_input(image, net_h, net_w, out=None, scratch=None):
+    """ Letterbox a BGR uint8 image into an RGB float32 network input.
+
+    The image is resized while still uint8 and normalised on the way into
+    out, a (net_h, net_w, 3) float32 array such as a BatchInput slot. Without
+    out a new (1, net_h, net_w, 3) array is returned. scratch, a dict, keeps
+    the uint8 resize buffers between calls.
+    """
+    new_h, new_w = letterbox_size(image.shape[0], image.shape[1], net_h, net_w)
+
+    if out is None:
+        batch = np.empty((1, net_h, net_w, 3), dtype=np.float32)
+        preprocess_input(image, net_h, net_w, batch[0])
+
+        return batch
 
     # resize the image to the new size
-    resized = cv2.resize(image[:,:,::-1]/255., (new_w, new_h))
+    if scratch is None:
+        resized = cv2.resize(image, (new_w, new_h))
+    else:
+        resized = scratch.get((new_h, new_w))
+        if resized is None:
+            resized = scratch[(new_h, new_w)] = np.empty((new_h, new_w, 3), dtype=np.uint8)
+
+        cv2.resize(image, (new_w, new_h), dst=resized)
 
     # embed the image into the standard letter box
-    new_image = np.ones((net_h, net_w, 3)) * 0.5
-    new_image[(net_h-new_h)//2:(net_h+new_h)//2, (net_w-new_w)//2:(net_w+new_w)//2, :] = resized
-    new_image = np.expand_dims(new_image, 0)
+    top, left = (net_h-new_h)//2, (net_w-new_w)//2
+
+    out[:top] = 0.5
+    out[top+new_h:] = 0.5
+    out[top:top+new_h, :left] = 0.5
+    out[top:top+new_h, left+new_w:] = 0.5
+    np.multiply(resized[:,:,::-1], np.float32(1/255.), out=out[top:top+new_h, left:left+new_w])
+
+    return out
+
+def letterbox_size(image_h, image_w, net_h, net_w):
+    # determine the new size of the image
+    if (float(net_w)/image_w) < (float(net_h)/image_h):
+        return (image_h * net_w)//image_w, net_w
+    else:
+        return net_h, (image_w * net_h)//image_h
+
+class BatchInput:
+    """ A float32 batch tensor reused across calls to get_yolo_boxes.
+
+    Images are preprocessed straight into its slots, so a batch costs no
+    temporaries beyond the uint8 resize. Images preprocessed ahead of their
+    batch, as the pipeline does, go into inputs handed out by slot() and
+    taken back by release(). Counts the bytes the float64 preprocessing used
+    to allocate for the same images.
+    """
 
-    return new_image
+    def __init__(self, net_h, net_w, size=8):
+        self.net_h  = net_h
+        self.net_w  = net_w
+        self.buffer  = None
+        self.scratch = {}
+        self.free    = []
+
+        self.images    = 0
+        self.allocated = 0
+        self.avoided   = 0
+        self.lock      = threading.Lock()
+
+        self.reserve(size)
+
+    def reserve(self, size):
+        if self.buffer is not None and len(self.buffer) >= size:
+            return
+
+        self.buffer = np.empty((size, self.net_h, self.net_w, 3), dtype=np.float32)
+
+        with self.lock:
+            self.allocated += self.buffer.nbytes
+
+    def fill(self, images):
+        """ Preprocesses images into the first slots, returns the batch view. """
+        self.reserve(len(images))
+
+        for i, image in enumerate(images):
+            preprocess_input(image, self.net_h, self.net_w, self.buffer[i], self.scratch)
+            self.count(image)
+
+        return self.buffer[:len(images)]
+
+    def slot(self):
+        """ A (net_h, net_w, 3) float32 input to preprocess into before its
+        batch is known, reused after release().
+        """
+        with self.lock:
+            if len(self.free) > 0:
+                return self.free.pop()
+
+            self.allocated += self.net_h * self.net_w * 3 * 4
+
+        return np.empty((self.net_h, self.net_w, 3), dtype=np.float32)
+
+    def stack(self, inputs):
+        """ Copies already preprocessed inputs into the first slots. """
+        self.reserve(len(inputs))
+
+        for i, item in enumerate(inputs):
+            self.buffer[i] = item
+
+        return self.buffer[:len(inputs)]
+
+    def release(self, inputs):
+        """ Takes back inputs from slot() once stacked. """
+        with self.lock:
+            self.free.extend(inputs)
+
+    def count(self, image, allocated=0):
+        """ Books one preprocessed image, and what it allocated outside the
+        buffer, against the float64 path.
+        """
+        h, w, _ = image.shape
+        new_h, new_w = letterbox_size(h, w, self.net_h, self.net_w)
+        canvas = self.net_h * self.net_w * 3 * 8
+
+        # float64 image/255., its resize, np.ones and the 0.5 multiple, the
+        # batch_input row
+        with self.lock:
+            self.images += 1
+            self.allocated += allocated
+            self.avoided += h * w * 3 * 8 + new_h * new_w * 3 * 8 + 3 * canvas
+
+    def stats(self):
+        return {
+            "images": self.images,
+            "allocated": self.allocated,
+            "avoided": self.avoided,
+        }
 
 def normalize(image):
     return image/255.
        
-def get_yolo_boxes(model, images, net_h, net_w, anchors, obj_thresh, nms_thresh):
-    image_h, image_w, _ = images[0].shape
+def get_yolo_boxes(model, images, net_h, net_w, anchors, obj_thresh, nms_thresh, nms_method="greedy", top_k=None, batch_buffer=None):
     nb_images           = len(images)
-    batch_input         = np.zeros((nb_images, net_h, net_w, 3))
+
+    if batch_buffer is None:
+        batch_buffer = BatchInput(net_h, net_w, nb_images)
 
     # preprocess the input
-    for i in range(nb_images):
-        batch_input[i] = preprocess_input(images[i], net_h, net_w)        
+    batch_input = batch_buffer.fill(images)
 
     # run the prediction
     batch_output = model.predict_on_batch(batch_input)
@@ -245,22 +497,30 @@ def get_yolo_boxes(model, images, net_h, net_w, anchors, obj_thresh, nms_thresh)
 
     for i in range(nb_images):
         yolos = [batch_output[0][i], batch_output[1][i], batch_output[2][i]]
-        boxes = []
 
-        # decode the output of the network
-        for j in range(len(yolos)):
-            yolo_anchors = anchors[(2-j)*6:(3-j)*6] # config['model']['anchors']
-            boxes += decode_netout(yolos[j], yolo_anchors, obj_thresh, net_h, net_w)
+        # images may differ in size
+        image_h, image_w, _ = images[i].shape
+        batch_boxes[i] = decode_yolos(yolos, image_h, image_w, net_h, net_w, anchors, obj_thresh, nms_thresh, nms_method, top_k)
+
+    return batch_boxes        
 
-        # correct the sizes of the bounding boxes
-        correct_yolo_boxes(boxes, image_h, image_w, net_h, net_w)
+def decode_yolos(yolos, image_h, image_w, net_h, net_w, anchors, obj_thresh, nms_thresh, nms_method="greedy", top_k=None):
+    # decode the output of the network
+    decoded = np.concatenate([
+        decode_netout_array(yolos[j], anchors[(2-j)*6:(3-j)*6], obj_thresh, net_h, net_w) # config['model']['anchors']
+        for j in range(len(yolos))
+    ])
 
-        # suppress non-maximal boxes
-        do_nms(boxes, nms_thresh)        
-           
-        batch_boxes[i] = boxes
+    # correct the sizes of the bounding boxes
+    coords = correct_yolo_boxes_array(decoded[:, :4], image_h, image_w, net_h, net_w)
 
-    return batch_boxes        
+    # suppress non-maximal boxes
+    classes = nms_array(coords.astype(np.float64), decoded[:, 5:], nms_thresh, nms_method, top_k, score_thresh=obj_thresh)
+
+    return [
+        BoundBox(xmin, ymin, xmax, ymax, objectness, scores)
+        for (xmin, ymin, xmax, ymax), objectness, scores in zip(coords.tolist(), decoded[:, 4], classes)
+    ]
 
 def compute_overlap(a, b):
     """